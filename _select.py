@@ -1,49 +1,66 @@
+import hashlib
+import html
+import json
 import logging
 import os
 import random
 import string
-from datetime import datetime, timedelta
-from urllib.parse import quote_plus
+import threading
+import time
+from collections import OrderedDict
 
-import pytz
-import requests
 from google.cloud import firestore
 
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-REDIRECT_URI = os.getenv("REDIRECT_URI")
+import database
+import metrics
+import twitch
+from tokens import get_app_token, lookup_token
+
 SELECT_URI = os.getenv("SELECT_URI")
 WEBHOOK_URI = os.getenv("WEBHOOK_URI")
 SECRET_LENGTH = int(os.getenv("SECRET_LENGTH", 32))
+REWARD_CACHE_TTL = int(os.getenv("REWARD_CACHE_TTL", 30))
+REWARD_CACHE_SIZE = int(os.getenv("REWARD_CACHE_SIZE", 1000))
+FILTER_COLUMNS = ("speaker", "source", "source_type")
+EVENTSUB_TRANSPORT = os.getenv("EVENTSUB_TRANSPORT", "webhook").lower()
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 logging.basicConfig()
 
-
-def store_oauth_token(
-    access_token,
-    refresh_token,
-    scopes,
-    expires_at,
-    broadcaster_id,
-    username,
-    document_id=None,
-):
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    token_data = {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "scopes": scopes,
-        "expires_at": expires_at,
-        "broadcaster_id": broadcaster_id,
-        "username": username,
-    }
-    if document_id:
-        tokens.document(document_id).update(token_data)
-    else:
-        tokens.add(token_data)
+# build expensive clients during the cold start rather than on the first request
+if database.PREWARM:
+    database.get_client()
+
+REWARD_CACHE = OrderedDict()
+REWARD_LOCK = threading.Lock()
+
+# compiled once per instance; pages are assembled with a single join
+PAGE_TEMPLATE = string.Template(
+    "<html><head><title>Lord of the Rings Channel Points</title>$refresh</head>"
+    '<body><table border="0" cellspacing="0" cellpadding="2">$banner'
+    "<tbody>$rows</tbody></table></body></html>"
+)
+REFRESH_TEMPLATE = string.Template(
+    '<meta http-equiv="refresh" content="5;url=$url" />'
+)
+BANNER_TEMPLATE = string.Template(
+    '<thead><tr><th colspan="2">$message</th></tr></thead>'
+)
+ROW_TEMPLATE = string.Template(
+    '<tr><td>$title</td><td><a href="$url">$verb</a></td></tr>'
+    '<tr><td colspan="2">$prompt ($points pts)</td></tr>$filter'
+)
+FILTER_TEMPLATE = string.Template(
+    '<tr><td colspan="2"><form action="$url" method="get">'
+    '<input type="hidden" name="broadcaster_id" value="$broadcaster_id" />'
+    '<input type="hidden" name="reward_id" value="$reward_id" />'
+    '<input type="hidden" name="action" value="filter" />'
+    'Speaker <input name="speaker" value="$speaker" /> '
+    'Source <input name="source" value="$source" /> '
+    'Type <input name="source_type" value="$source_type" /> '
+    '<input type="submit" value="Filter quotes" /></form></td></tr>'
+)
 
 
 def generate_secret(n_characters):
@@ -53,65 +70,11 @@ def generate_secret(n_characters):
     )
 
 
-def regenerate_token(token_data, document_id=None):
-    refresh_token = token_data.get("refresh_token")
-    url = (
-        "https://id.twitch.tv/oauth2/token?client_id="
-        + quote_plus(CLIENT_ID)
-        + "&client_secret="
-        + quote_plus(CLIENT_SECRET)
-        + "&refresh_token="
-        + quote_plus(refresh_token)
-        + "&grant_type=refresh_token&redirect_uri="
-        + quote_plus(REDIRECT_URI)
-    )
-    result = requests.post(url)
-    result.raise_for_status()
-    response = result.json()
-
-    # get the tokens and metadata from the oauth response
-    access_token = response.get("access_token")
-    scopes = response.get("scope")
-    expires_in = response.get("expires_in")
-
-    # calculate the expiration timestamp
-    expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
-
-    broadcaster_id = token_data.get("broadcaster_id")
-    username = token_data.get("username")
-    store_oauth_token(
-        access_token,
-        refresh_token,
-        scopes,
-        expires_at,
-        broadcaster_id,
-        username,
-        document_id,
-    )
-    return access_token
-
-
-def lookup_token(broadcaster_id):
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    result = tokens.where("broadcaster_id", "==", broadcaster_id)
-    document = result.get()[0]
-    token_data = document.to_dict()
-    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    if token_data.get("expires_at") < now:
-        access_token = regenerate_token(token_data, document.id)
-    else:
-        access_token = token_data.get("access_token")
-    return access_token
-
-
 def get_rewards(broadcaster_id, access_token):
-    headers = {
-        "Client-Id": CLIENT_ID,
-        "Authorization": f"Bearer {access_token}",
-    }
-    url = f"https://api.twitch.tv/helix/channel_points/custom_rewards?broadcaster_id={broadcaster_id}"
-    result = requests.get(url, headers=headers)
+    params = {"broadcaster_id": broadcaster_id}
+    result = twitch.helix(
+        "GET", "channel_points/custom_rewards", access_token, params=params
+    )
     result.raise_for_status()
     response = result.json()
     LOGGER.info(response)
@@ -125,43 +88,61 @@ def get_rewards(broadcaster_id, access_token):
     }
 
 
+def get_cached_rewards(broadcaster_id, refresh=False):
+    now = time.monotonic()
+    with REWARD_LOCK:
+        entry = REWARD_CACHE.get(broadcaster_id)
+        if entry and not refresh and now - entry[0] < REWARD_CACHE_TTL:
+            REWARD_CACHE.move_to_end(broadcaster_id)
+            return entry[1]
+    access_token = lookup_token(broadcaster_id)
+    rewards = get_rewards(broadcaster_id, access_token)
+    with REWARD_LOCK:
+        REWARD_CACHE[broadcaster_id] = (now, rewards)
+        REWARD_CACHE.move_to_end(broadcaster_id)
+        while len(REWARD_CACHE) > REWARD_CACHE_SIZE:
+            REWARD_CACHE.popitem(last=False)
+    return rewards
+
+
 def get_active_subscription(broadcaster_id):
-    db = firestore.Client()
-    subscriptions = db.collection("subscriptions")
-    result = subscriptions.where("broadcaster_id", "==", broadcaster_id)
-    return next((x.to_dict() for x in result.get()), None)
-
-
-def get_app_token(scopes):
-    url = (
-        "https://id.twitch.tv/oauth2/token?client_id="
-        + quote_plus(CLIENT_ID)
-        + "&client_secret="
-        + quote_plus(CLIENT_SECRET)
-        + "&scope="
-        + quote_plus(" ".join(scopes))
-        + "&grant_type=client_credentials"
+    db = database.get_client()
+    document = db.collection("subscriptions").document(broadcaster_id).get()
+    metrics.increment("firestore_reads")
+    if document.exists:
+        return document.to_dict()
+    # records from before migrate.py ran are re-keyed on first use
+    subscription = database.adopt_legacy(
+        "subscriptions",
+        broadcaster_id,
+        "broadcaster_id",
+        "==",
+        broadcaster_id,
+        key=lambda x: bool(x.to_dict().get("subscription_id")),
     )
-    result = requests.post(url)
-    result.raise_for_status()
-    response = result.json()
-    return response.get("access_token")
+    metrics.increment("firestore_reads")
+    if subscription:
+        metrics.increment("firestore_writes")
+    return subscription
+
+
+def app_helix(method, path, scopes, **kwargs):
+    result = twitch.helix(method, path, get_app_token(scopes), **kwargs)
+    if result.status_code == 401:
+        # the cached app token was revoked or expired early, so mint a new one
+        app_token = get_app_token(scopes, refresh=True)
+        result = twitch.helix(method, path, app_token, **kwargs)
+    return result
 
 
 def subscribe(broadcaster_id, secret, scopes):
-    app_token = get_app_token(scopes)
-    url = "https://api.twitch.tv/helix/eventsub/subscriptions"
     data = {
         "type": "channel.channel_points_custom_reward_redemption.add",
         "version": "1",
         "condition": {"broadcaster_user_id": str(broadcaster_id),},
         "transport": {"method": "webhook", "callback": WEBHOOK_URI, "secret": secret,},
     }
-    headers = {
-        "Authorization": f"Bearer {app_token}",
-        "Client-Id": CLIENT_ID,
-    }
-    result = requests.post(url, json=data, headers=headers)
+    result = app_helix("POST", "eventsub/subscriptions", scopes, json=data)
     result.raise_for_status()
     response = result.json()
 
@@ -170,121 +151,200 @@ def subscribe(broadcaster_id, secret, scopes):
 
 
 def unsubscribe(subscription_id, scopes):
-    app_token = get_app_token(scopes)
-    url = f"https://api.twitch.tv/helix/eventsub/subscriptions?id={subscription_id}"
-    headers = {
-        "Authorization": f"Bearer {app_token}",
-        "Client-Id": CLIENT_ID,
-    }
-    result = requests.delete(url, headers=headers)
+    params = {"id": subscription_id}
+    result = app_helix("DELETE", "eventsub/subscriptions", scopes, params=params)
     result.raise_for_status()
 
 
-def update_subscription_record(subscription_data):
-    db = firestore.Client()
-    broadcaster_id = subscription_data.get("broadcaster_id")
-    subscriptions = db.collection("subscriptions")
-    result = subscriptions.where("broadcaster_id", "==", broadcaster_id)
-    documents = result.get()
-    document_id = documents[0].id if documents else None
-    if document_id:
-        subscriptions.document(document_id).update(subscription_data)
-    else:
-        subscriptions.add(subscription_data)
-
-
-def delete_subscription_record(subscription_id):
-    db = firestore.Client()
-    subscriptions = db.collection("subscriptions")
-    result = subscriptions.where("subscription_id", "==", subscription_id)
-    document = result.get()[0]
-    subscriptions.document(document.id).delete()
+@firestore.transactional
+def add_reward(transaction, reference, broadcaster_id, reward_id):
+    snapshot = reference.get(transaction=transaction)
+    if snapshot.exists:
+        reward_ids = firestore.ArrayUnion([reward_id])
+        transaction.update(reference, {"reward_ids": reward_ids})
+        subscription = snapshot.to_dict()
+        # a record without a subscription id never finished subscribing, so retry it
+        if subscription.get("subscription_id"):
+            return None
+        return subscription.get("secret")
+    secret = generate_secret(SECRET_LENGTH)
+    transaction.create(
+        reference,
+        {
+            "reward_ids": [reward_id],
+            "broadcaster_id": broadcaster_id,
+            "secret": secret,
+        },
+    )
+    return secret
+
+
+@firestore.transactional
+def remove_reward(transaction, reference, reward_id):
+    snapshot = reference.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    subscription = snapshot.to_dict()
+    if [x for x in subscription.get("reward_ids", []) if x != reward_id]:
+        reward_ids = firestore.ArrayRemove([reward_id])
+        filter_path = firestore.Client.field_path("reward_filters", reward_id)
+        transaction.update(
+            reference, {"reward_ids": reward_ids, filter_path: firestore.DELETE_FIELD}
+        )
+        return None
+    transaction.delete(reference)
+    return subscription
+
+
+def connect_reward(broadcaster_id, reward_id):
+    # returns the secret when the record still needs an eventsub subscription
+    db = database.get_client()
+    reference = db.collection("subscriptions").document(broadcaster_id)
+    secret = add_reward(db.transaction(), reference, broadcaster_id, reward_id)
+    metrics.increment("firestore_reads")
+    metrics.increment("firestore_writes")
+    return secret
+
+
+def disconnect_reward(broadcaster_id, reward_id):
+    # returns the deleted record when this click removed the last reward
+    db = database.get_client()
+    reference = db.collection("subscriptions").document(broadcaster_id)
+    subscription = remove_reward(db.transaction(), reference, reward_id)
+    metrics.increment("firestore_reads")
+    metrics.increment("firestore_writes")
+    return subscription
+
+
+def set_subscription_id(broadcaster_id, subscription_id):
+    db = database.get_client()
+    reference = db.collection("subscriptions").document(broadcaster_id)
+    reference.update({"subscription_id": subscription_id})
+    metrics.increment("firestore_writes")
+
+
+def set_reward_filters(broadcaster_id, reward_id, filters):
+    # filters are keyed per reward so one broadcaster can run several quote rewards
+    db = database.get_client()
+    reference = db.collection("subscriptions").document(broadcaster_id)
+    filter_path = db.field_path("reward_filters", reward_id)
+    reference.update({filter_path: filters or firestore.DELETE_FIELD})
+    metrics.increment("firestore_writes")
+
+
+def page_etag(broadcaster_id, rewards, connected_rewards, message_banner, filters):
+    # everything the page renders from, so a match can skip rendering entirely
+    state = [broadcaster_id, rewards, connected_rewards, message_banner, filters]
+    encoded = json.dumps(state, sort_keys=True, default=str).encode("utf-8")
+    digest = hashlib.sha1(encoded)
+    return '"' + digest.hexdigest() + '"'
+
+
+def generate_filter(broadcaster_id, reward_id, filters):
+    return FILTER_TEMPLATE.substitute(
+        url=html.escape(SELECT_URI or ""),
+        broadcaster_id=html.escape(broadcaster_id),
+        reward_id=html.escape(reward_id),
+        **{x: html.escape(filters.get(x, "")) for x in FILTER_COLUMNS},
+    )
 
 
-def generate_html(broadcaster_id, rewards, connected_rewards, message_banner):
-    html = "<html>"
-    html += "<head><title>Lord of the Rings Channel Points</title>"
+def generate_html(
+    broadcaster_id, rewards, connected_rewards, message_banner, reward_filters
+):
+    refresh = banner = ""
     if message_banner:
         url = f"{SELECT_URI}?broadcaster_id={broadcaster_id}"
-        html += '<meta http-equiv="refresh" content="5;url=' + url + '" />'
-    html += "</head><body>"
-    html += '<table border="0" cellspacing="0" cellpadding="2">'
-    if message_banner:
-        html += '<thead><tr><th colspan="2">' + message_banner + "</th></tr></thead>"
-    html += "<tbody>"
-    for reward_id, reward in rewards.items():
-        points = str(reward.get("cost"))
-        url = f"{SELECT_URI}?broadcaster_id={broadcaster_id}&reward_id={reward_id}"
-        verb = "Disconnect" if reward_id in connected_rewards else "Connect"
-        html += "<tr><td>" + reward.get("title") + "</td>"
-        html += '<td><a href="' + url + '">' + verb + "</a></td></tr>"
-        html += (
-            '<tr><td colspan="2">' + reward.get("prompt") + f" ({points} pts)</td></tr>"
+        refresh = REFRESH_TEMPLATE.substitute(url=html.escape(url))
+        banner = BANNER_TEMPLATE.substitute(message=html.escape(message_banner))
+    rows = "".join(
+        ROW_TEMPLATE.substitute(
+            title=html.escape(reward.get("title")),
+            url=html.escape(
+                f"{SELECT_URI}?broadcaster_id={broadcaster_id}&reward_id={reward_id}"
+            ),
+            verb="Disconnect" if reward_id in connected_rewards else "Connect",
+            prompt=html.escape(reward.get("prompt")),
+            points=reward.get("cost"),
+            filter=generate_filter(
+                broadcaster_id, reward_id, reward_filters.get(reward_id, {})
+            )
+            if reward_id in connected_rewards
+            else "",
         )
-    html += "</tbody></table>"
-    html += "</body></html>"
-    LOGGER.info(html)
-    return html
+        for reward_id, reward in rewards.items()
+    )
+    page = PAGE_TEMPLATE.substitute(refresh=refresh, banner=banner, rows=rows)
+    LOGGER.debug(page)
+    return page
 
 
 def handler(request):
     broadcaster_id = request.args.get("broadcaster_id")
-    access_token = lookup_token(broadcaster_id)
-    rewards = get_rewards(broadcaster_id, access_token)
+    rewards = get_cached_rewards(broadcaster_id)
 
     message_banner = None
     active_subscription = get_active_subscription(broadcaster_id)
     if active_subscription:
         LOGGER.info(active_subscription)
         connected_rewards = active_subscription.get("reward_ids", [])
+        reward_filters = active_subscription.get("reward_filters", {})
     else:
         connected_rewards = []
+        reward_filters = {}
 
     reward_id = request.args.get("reward_id")
+    action = request.args.get("action")
     LOGGER.info(f"Reward ID: {reward_id}")
     app_scopes = ["channel:read:redemptions", "channel:manage:redemptions"]
 
+    if reward_id and reward_id not in rewards:
+        # the reward may have been created since the list was cached
+        rewards = get_cached_rewards(broadcaster_id, refresh=True)
+
     if reward_id:
         if reward_id not in rewards:
             message_banner = "Invalid Reward Selected"
-        elif not active_subscription:
-            # subscribe and insert
+        elif action == "filter":
             reward_name = rewards[reward_id].get("title")
-            message_banner = f"Successfully connected reward: {reward_name}"
-            secret = generate_secret(SECRET_LENGTH)
-            active_subscription = {
-                "reward_ids": [reward_id],
-                "broadcaster_id": broadcaster_id,
-                "secret": secret,
-            }
-            # might be overkill to insert this early, but just trying to beat a race condition
-            update_subscription_record(active_subscription)
-            subscription_id = subscribe(broadcaster_id, secret, app_scopes)
-            active_subscription["subscription_id"] = subscription_id
-            connected_rewards.append(reward_id)
-            update_subscription_record(active_subscription)
+            if reward_id in connected_rewards:
+                filters = {
+                    x: request.args.get(x, "").strip()
+                    for x in FILTER_COLUMNS
+                    if request.args.get(x, "").strip()
+                }
+                set_reward_filters(broadcaster_id, reward_id, filters)
+                reward_filters[reward_id] = filters
+                message_banner = f"Updated quote filter for: {reward_name}"
+            else:
+                message_banner = f"Connect {reward_name} before filtering its quotes"
         elif reward_id not in connected_rewards:
-            # update record only
             reward_name = rewards[reward_id].get("title")
             message_banner = f"Successfully connected reward: {reward_name}"
+            # the record is written before subscribing so concurrent clicks see it
+            secret = connect_reward(broadcaster_id, reward_id)
+            # the eventsub worker subscribes over its own websocket session instead
+            if secret and EVENTSUB_TRANSPORT == "webhook":
+                try:
+                    subscription_id = subscribe(broadcaster_id, secret, app_scopes)
+                except Exception:
+                    # roll back so the page never shows a reward that cannot notify
+                    disconnect_reward(broadcaster_id, reward_id)
+                    raise
+                set_subscription_id(broadcaster_id, subscription_id)
             connected_rewards.append(reward_id)
-            active_subscription["reward_ids"] = connected_rewards
-            update_subscription_record(active_subscription)
-        elif len(connected_rewards) > 1:
-            # update record only
-            reward_name = rewards[reward_id].get("title")
-            message_banner = f"Successfully disconnected reward: {reward_name}"
-            connected_rewards = [x for x in connected_rewards if x != reward_id]
-            active_subscription["reward_ids"] = connected_rewards
-            update_subscription_record(active_subscription)
         else:
-            # unsubscribe and delete
             reward_name = rewards[reward_id].get("title")
             message_banner = f"Successfully disconnected reward: {reward_name}"
             connected_rewards = [x for x in connected_rewards if x != reward_id]
-            subscription_id = active_subscription.get("subscription_id")
-            unsubscribe(subscription_id, app_scopes)
-            delete_subscription_record(subscription_id)
+            deleted_subscription = disconnect_reward(broadcaster_id, reward_id)
+            subscription_id = (deleted_subscription or {}).get("subscription_id")
+            if subscription_id:
+                unsubscribe(subscription_id, app_scopes)
 
     # display HTML to let the user select which reward
-    return generate_html(broadcaster_id, rewards, connected_rewards, message_banner)
+    args = (broadcaster_id, rewards, connected_rewards, message_banner, reward_filters)
+    etag = page_etag(*args)
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+    return generate_html(*args), 200, {"ETag": etag}
@@ -1,14 +1,13 @@
 import logging
 import os
 from datetime import datetime, timedelta
-from urllib.parse import quote_plus
 
 import flask
-import requests
-from google.cloud import firestore
 
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+import database
+import twitch
+from tokens import store_oauth_token, token_document_ids
+
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 SELECT_URI = os.getenv("SELECT_URI")
 
@@ -16,31 +15,25 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 logging.basicConfig()
 
+# build expensive clients during the cold start rather than on the first request
+if database.PREWARM:
+    database.get_client()
+
 
 def respond_to_auth_code_request(auth_code):
-    url = (
-        "https://id.twitch.tv/oauth2/token?client_id="
-        + quote_plus(CLIENT_ID)
-        + "&client_secret="
-        + quote_plus(CLIENT_SECRET)
-        + "&code="
-        + quote_plus(auth_code)
-        + "&grant_type=authorization_code&redirect_uri="
-        + quote_plus(REDIRECT_URI)
+    result = twitch.oauth_token(
+        {
+            "code": auth_code,
+            "grant_type": "authorization_code",
+            "redirect_uri": REDIRECT_URI,
+        }
     )
-    result = requests.post(url)
     result.raise_for_status()
     return result.json()
 
 
 def retrieve_user_data(access_token):
-    headers = {
-        "Client-Id": CLIENT_ID,
-        "Authorization": f"Bearer {access_token}",
-    }
-
-    url = "https://api.twitch.tv/helix/users"
-    result = requests.get(url, headers=headers)
+    result = twitch.helix("GET", "users", access_token)
     result.raise_for_status()
     response = result.json()
 
@@ -52,31 +45,6 @@ def retrieve_user_data(access_token):
     return broadcaster_id, username
 
 
-def store_oauth_token(
-    access_token,
-    refresh_token,
-    scopes,
-    expires_at,
-    broadcaster_id,
-    username,
-    document_id=None,
-):
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    token_data = {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "scopes": scopes,
-        "expires_at": expires_at,
-        "broadcaster_id": broadcaster_id,
-        "username": username,
-    }
-    if document_id:
-        tokens.document(document_id).update(token_data)
-    else:
-        tokens.add(token_data)
-
-
 def handler(request):
     # complete the oauth code grant flow
     auth_code = request.args.get("code")
@@ -95,9 +63,16 @@ def handler(request):
     broadcaster_id, username = retrieve_user_data(access_token)
 
     # store auth tokens
-    store_oauth_token(
-        access_token, refresh_token, scopes, expires_at, broadcaster_id, username
-    )
+    for document_id in token_document_ids(scopes, broadcaster_id):
+        store_oauth_token(
+            access_token,
+            refresh_token,
+            scopes,
+            expires_at,
+            broadcaster_id,
+            username,
+            document_id,
+        )
 
     if "channel:read:redemptions" in scopes:
         LOGGER.info("Redirecting user to reward selection")
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import os
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BROADCASTER_ID = "1000"
+BROADCASTER_LOGIN = "benchmark"
+REWARD_ID = "bench-reward"
+SECRET = "benchmark-secret"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+# in-memory firestore
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field)
+
+
+class FakeDocument:
+    def __init__(self, collection, document_id):
+        self.collection = collection
+        self.id = document_id
+
+    def get(self, transaction=None):
+        self.collection.client.count("reads")
+        return FakeSnapshot(self, self.collection.documents.get(self.id))
+
+    def set(self, data, merge=False):
+        self.collection.client.count("writes")
+        with self.collection.client.lock:
+            current = self.collection.documents.get(self.id, {}) if merge else {}
+            self.collection.documents[self.id] = {**current, **data}
+
+    def update(self, data):
+        self.set(data, merge=True)
+
+    def create(self, data):
+        from google.api_core.exceptions import AlreadyExists
+
+        with self.collection.client.lock:
+            if self.id in self.collection.documents:
+                raise AlreadyExists(self.id)
+        self.set(data)
+
+    def delete(self):
+        self.collection.client.count("writes")
+        with self.collection.client.lock:
+            self.collection.documents.pop(self.id, None)
+
+
+class FakeQuery:
+    OPERATORS = {
+        "==": lambda x, y: x == y,
+        ">=": lambda x, y: x is not None and x >= y,
+        "<=": lambda x, y: x is not None and x <= y,
+        "array_contains": lambda x, y: y in (x or []),
+    }
+
+    def __init__(self, collection, filters=(), limit=None):
+        self.collection = collection
+        self.filters = filters
+        self.count = limit
+
+    def where(self, field, operator, value):
+        filters = self.filters + ((field, operator, value),)
+        return FakeQuery(self.collection, filters, self.count)
+
+    def limit(self, count):
+        return FakeQuery(self.collection, self.filters, count)
+
+    def stream(self):
+        with self.collection.client.lock:
+            items = list(self.collection.documents.items())
+        results = [
+            FakeSnapshot(self.collection.document(x), y)
+            for x, y in items
+            if all(self.OPERATORS[o](y.get(f), v) for f, o, v in self.filters)
+        ][: self.count]
+        self.collection.client.count("reads", max(len(results), 1))
+        return iter(results)
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, name):
+        super().__init__(self)
+        self.client = client
+        self.name = name
+        self.documents = {}
+
+    def document(self, document_id):
+        return FakeDocument(self, document_id)
+
+    def on_snapshot(self, callback):
+        return self
+
+
+class FakeClient:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections = {}
+        self.operations = {"reads": 0, "writes": 0}
+
+    def count(self, operation, amount=1):
+        with self.lock:
+            self.operations[operation] += amount
+
+    def collection(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FakeCollection(self, name)
+            return self.collections[name]
+
+
+# local stand-ins for twitch helix/oauth and irc
+
+
+class HelixStub(BaseHTTPRequestHandler):
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        with self.server.lock:
+            endpoint = f"{self.command} {self.path.split('?')[0]}"
+            self.server.calls[endpoint] = self.server.calls.get(endpoint, 0) + 1
+        body = json.dumps(
+            {"access_token": "stub", "expires_in": 3600, "scope": [], "data": []}
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class IrcStub(socketserver.StreamRequestHandler):
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        while True:
+            line = self.rfile.readline().decode("utf-8").strip()
+            if not line:
+                break
+            key, value = line.split(":", 1)
+            headers[key.lower()] = value.strip()
+        key = headers.get("sec-websocket-key", "") + WEBSOCKET_GUID
+        accept = base64.b64encode(hashlib.sha1(key.encode("utf-8")).digest())
+        self.wfile.write(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+            b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        while True:
+            frame = self.read_frame()
+            if frame is None or frame[0] == 0x8:
+                return
+            opcode, payload = frame
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode == 0x1:
+                for line in payload.decode("utf-8").splitlines():
+                    if line.startswith("NICK"):
+                        self.send_frame(0x1, b":tmi.twitch.tv 001 bench :Welcome")
+                    elif line.startswith("PRIVMSG"):
+                        with self.server.lock:
+                            self.server.messages += 1
+
+    def read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else b""
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
+        return opcode, payload
+
+    def send_frame(self, opcode, payload):
+        if len(payload) < 126:
+            header = struct.pack(">BB", 0x80 | opcode, len(payload))
+        else:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, len(payload))
+        self.wfile.write(header + payload)
+
+
+def start_server(server_class, handler):
+    server = server_class(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.messages = 0
+    server.calls = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# load generation
+
+
+class FakeRequest:
+    def __init__(self, headers, data):
+        self.headers = headers
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+
+def seed(db):
+    subscriptions = db.collection("subscriptions")
+    subscriptions.document(BROADCASTER_ID).set(
+        {
+            "broadcaster_id": BROADCASTER_ID,
+            "reward_ids": [REWARD_ID],
+            "secret": SECRET,
+            "subscription_id": "bench-subscription",
+        }
+    )
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    tokens = db.collection("auth-tokens")
+    for document_id, scopes in [
+        ("chat-bot", ["chat:edit"]),
+        (f"broadcaster-{BROADCASTER_ID}", ["channel:manage:redemptions"]),
+    ]:
+        tokens.document(document_id).set(
+            {
+                "access_token": "bench-token",
+                "refresh_token": "bench-refresh",
+                "scopes": scopes,
+                "expires_at": expires_at,
+                "broadcaster_id": BROADCASTER_ID,
+                "username": "bench",
+            }
+        )
+    quotes = db.collection("lotr-quotes")
+    with open("quotes.csv", newline="") as fh:
+        for id, row in enumerate(csv.DictReader(fh), start=1):
+            quotes.document(str(id)).set(
+                {"id": id, "quote": row.get("Quote"), "speaker": row.get("Speaker")}
+            )
+    db.collection("quote-metadata").document("lotr-quotes").set(
+        {"count": id, "min_id": 1, "max_id": id, "version": 1}
+    )
+
+
+def make_notification(webhook):
+    message_id = str(uuid.uuid4())
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    body = json.dumps(
+        {
+            "subscription": {
+                "type": "channel.channel_points_custom_reward_redemption.add",
+                "condition": {"broadcaster_user_id": BROADCASTER_ID},
+            },
+            "event": {
+                "id": str(uuid.uuid4()),
+                "broadcaster_user_id": BROADCASTER_ID,
+                "broadcaster_user_login": BROADCASTER_LOGIN,
+                "reward": {"id": REWARD_ID},
+            },
+        }
+    ).encode("utf-8")
+    signature = webhook.calculate_message_signature(SECRET, message_id, timestamp, body)
+    headers = {
+        "Twitch-Eventsub-Message-Id": message_id,
+        "Twitch-Eventsub-Message-Timestamp": timestamp,
+        "Twitch-Eventsub-Message-Type": "notification",
+        "Twitch-Eventsub-Message-Signature": signature,
+    }
+    return FakeRequest(headers, body)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the webhook end to end")
+    parser.add_argument("--rate", type=float, default=20, help="redemptions per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--burst", type=int, default=1, help="redemptions per tick")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument(
+        "--emulator", action="store_true", help="use FIRESTORE_EMULATOR_HOST"
+    )
+    args = parser.parse_args()
+
+    helix = start_server(ThreadingHTTPServer, HelixStub)
+    irc = start_server(socketserver.ThreadingTCPServer, IrcStub)
+    os.environ.setdefault("CLIENT_ID", "bench")
+    os.environ.setdefault("CLIENT_SECRET", "bench")
+    os.environ["TWITCH_API_URI"] = f"http://127.0.0.1:{helix.server_address[1]}/helix"
+    os.environ["TWITCH_AUTH_URI"] = f"http://127.0.0.1:{helix.server_address[1]}/oauth2"
+    os.environ["CHAT_URI"] = f"ws://127.0.0.1:{irc.server_address[1]}"
+
+    # the fake has to be installed before any function module builds a client
+    import database
+
+    if not args.emulator:
+        database.CLIENT = FakeClient()
+    seed(database.get_client())
+    import chat
+    import webhook
+
+    fake = database.CLIENT if not args.emulator else None
+    operations_before = dict(fake.operations) if fake else None
+    latencies = []
+    failures = 0
+    started = time.monotonic()
+
+    def fire(request):
+        began = time.perf_counter()
+        result = webhook.handler(request)
+        return time.perf_counter() - began, result
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        ticks = int(args.rate * args.duration / args.burst)
+        for tick in range(ticks):
+            delay = started + tick * args.burst / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for _ in range(args.burst):
+                futures.append(executor.submit(fire, make_notification(webhook)))
+        for future in futures:
+            elapsed, result = future.result()
+            latencies.append(elapsed)
+            failures += result[1] != 204
+    elapsed = time.monotonic() - started
+    drained = chat.flush(timeout=args.drain_timeout)
+
+    count = len(latencies)
+    print(f"redemptions:        {count} in {elapsed:.2f}s ({count / elapsed:.1f}/s)")
+    print(f"failures:           {failures}")
+    for label, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]:
+        latency = percentile(latencies, fraction) * 1000
+        print(f"latency {label}:        {latency:.1f} ms")
+    undrained = "" if drained else " (queue not drained)"
+    print(f"chat delivered:     {irc.messages}{undrained}")
+    if fake:
+        for operation, total in fake.operations.items():
+            per = (total - operations_before[operation]) / count
+            print(f"firestore {operation:<9} {per:.2f} per redemption")
+    for endpoint, total in sorted(helix.calls.items()):
+        print(f"helix {endpoint}: {total}")
+
+
+if __name__ == "__main__":
+    main()
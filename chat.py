@@ -0,0 +1,349 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+CHAT_URI = os.getenv("CHAT_URI", "wss://irc-ws.chat.twitch.tv:443")
+CHAT_FLUSH_TIMEOUT = float(os.getenv("CHAT_FLUSH_TIMEOUT", 10))
+CHAT_RATE_LIMIT = int(os.getenv("CHAT_RATE_LIMIT", 20))
+CHAT_RATE_PERIOD = float(os.getenv("CHAT_RATE_PERIOD", 30))
+CHANNEL_RATE_LIMIT = int(os.getenv("CHANNEL_RATE_LIMIT", 1))
+CHANNEL_RATE_PERIOD = float(os.getenv("CHANNEL_RATE_PERIOD", 1))
+CHAT_MAX_PENDING = int(os.getenv("CHAT_MAX_PENDING", 10))
+CHAT_OVERFLOW_POLICY = os.getenv("CHAT_OVERFLOW_POLICY", "coalesce")
+CHAT_CHANNELS_PER_SHARD = int(os.getenv("CHAT_CHANNELS_PER_SHARD", 50))
+CHAT_MAX_CONNECTIONS = int(os.getenv("CHAT_MAX_CONNECTIONS", 5))
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+
+class SlidingWindow:
+    # a log of send times, so no window of `period` seconds ever exceeds `limit`
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.sends = deque()
+
+    def expire(self, now):
+        while self.sends and now - self.sends[0] >= self.period:
+            self.sends.popleft()
+
+    def wait_time(self, now):
+        self.expire(now)
+        if len(self.sends) < self.limit:
+            return 0.0
+        return self.sends[0] + self.period - now
+
+    def consume(self, now):
+        self.expire(now)
+        self.sends.append(now)
+
+
+class ChatScheduler:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.global_window = SlidingWindow(CHAT_RATE_LIMIT, CHAT_RATE_PERIOD)
+        self.channel_windows = {}
+        self.pending = OrderedDict()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.inflight = 0
+
+    def submit(self, channel, message):
+        # returns an event that is set once the message has left the queue
+        delivered = threading.Event()
+        with self.condition:
+            queue = self.pending.setdefault(channel, deque())
+            if len(queue) >= CHAT_MAX_PENDING:
+                if CHAT_OVERFLOW_POLICY == "coalesce":
+                    # keep the original place in line but deliver the newest message
+                    _, queued_at, replaced = queue[-1]
+                    queue[-1] = (message, queued_at, delivered)
+                    replaced.set()
+                    self.coalesced += 1
+                    metrics.increment("chat_coalesced")
+                    LOGGER.warning(f"Coalesced chat message for #{channel}")
+                    return delivered
+                self.dropped += 1
+                metrics.increment("chat_dropped")
+                LOGGER.warning(f"Dropped chat message for #{channel}")
+                return None
+            queue.append((message, time.monotonic(), delivered))
+            self.condition.notify_all()
+            return delivered
+
+    def poll(self, channels):
+        # caller must hold the condition; returns (channel, message) or a delay
+        candidates = [x for x in self.pending if x in channels]
+        if not candidates:
+            return None, None
+        now = time.monotonic()
+        delay = self.global_window.wait_time(now)
+        if delay:
+            return None, delay
+        for channel in candidates:
+            window = self.channel_windows.get(channel)
+            if window is None:
+                window = SlidingWindow(CHANNEL_RATE_LIMIT, CHANNEL_RATE_PERIOD)
+                self.channel_windows[channel] = window
+            channel_delay = window.wait_time(now)
+            if channel_delay:
+                delay = min(delay or channel_delay, channel_delay)
+                continue
+            queue = self.pending.pop(channel)
+            message, queued_at, delivered = queue.popleft()
+            if queue:
+                # re-inserting at the end gives round-robin fairness across channels
+                self.pending[channel] = queue
+            window.consume(now)
+            self.global_window.consume(now)
+            self.sent += 1
+            self.inflight += 1
+            self.total_wait += now - queued_at
+            return (channel, message, delivered), None
+        return None, delay
+
+    def requeue(self, channel, message, delivered):
+        with self.condition:
+            queue = self.pending.setdefault(channel, deque())
+            queue.appendleft((message, time.monotonic(), delivered))
+            self.pending.move_to_end(channel, last=False)
+            self.sent -= 1
+            self.inflight -= 1
+            self.condition.notify_all()
+
+    def delivered(self):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify_all()
+
+    def withdraw(self, channel, delivered):
+        # drops a message that is still queued; false once a writer has taken it
+        with self.condition:
+            queue = self.pending.get(channel, ())
+            for item in queue:
+                if item[2] is delivered:
+                    queue.remove(item)
+                    if not queue:
+                        del self.pending[channel]
+                    self.dropped += 1
+                    metrics.increment("chat_dropped")
+                    self.condition.notify_all()
+                    return True
+            return False
+
+    def idle(self):
+        # caller must hold the condition
+        return not self.pending and not self.inflight
+
+    def queue_depth(self, channel=None):
+        with self.condition:
+            if channel is not None:
+                return len(self.pending.get(channel, ()))
+            return sum(len(x) for x in self.pending.values())
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            return {
+                "queue_depth": sum(len(x) for x in self.pending.values()),
+                "channels": {x: len(y) for x, y in self.pending.items()},
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "average_wait": self.total_wait / self.sent if self.sent else 0.0,
+                "next_wait": self.global_window.wait_time(now),
+            }
+
+
+SCHEDULER = ChatScheduler()
+
+
+class ChatConnection:
+    def __init__(self, username, access_token):
+        self.username = username
+        self.access_token = access_token
+        self.channels = set()
+        self.assigned = set()
+        self.ready = False
+        self.closed = False
+        # deferred so paths that never send chat don't pay for the import
+        from websocket import WebSocketApp
+
+        self.ws = WebSocketApp(
+            CHAT_URI,
+            on_open=self.on_open,
+            on_message=self.on_message,
+            on_error=self.on_error,
+            on_close=self.on_close,
+        )
+        threading.Thread(target=self.run, daemon=True).start()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def run(self):
+        self.ws.run_forever(ping_interval=70, ping_timeout=10)
+        self.close()
+
+    def close(self):
+        with SCHEDULER.condition:
+            self.closed = True
+            self.ready = False
+            SCHEDULER.condition.notify_all()
+        self.ws.keep_running = False
+
+    def on_open(self, ws):
+        # authenticate once; the socket is reused until it drops or the token rotates
+        ws.send(f"PASS oauth:{self.access_token}")
+        ws.send(f"NICK {self.username}")
+        LOGGER.info(f"NICK {self.username}")
+
+    def on_message(self, ws, message):
+        for line in message.splitlines():
+            if line.startswith("PING"):
+                ws.send(line.replace("PING", "PONG", 1))
+            elif " 001 " in line:
+                LOGGER.info("Chat connection authenticated")
+                with SCHEDULER.condition:
+                    self.ready = True
+                    SCHEDULER.condition.notify_all()
+            elif "Login authentication failed" in line:
+                LOGGER.error("Chat authentication failed")
+                self.close()
+
+    def on_error(self, ws, error):
+        LOGGER.error(f"Error in websocket: {error}")
+
+    def on_close(self, ws, *args):
+        LOGGER.info("Chat closed")
+        self.close()
+
+    def assign(self, channel):
+        with SCHEDULER.condition:
+            self.assigned.add(channel)
+            SCHEDULER.condition.notify_all()
+
+    def join(self, channel):
+        if channel not in self.channels:
+            self.ws.send(f"JOIN #{channel}")
+            LOGGER.info(f"JOIN #{channel}")
+            self.channels.add(channel)
+
+    def write(self):
+        from websocket import WebSocketException
+
+        while True:
+            with SCHEDULER.condition:
+                while True:
+                    if self.closed:
+                        return
+                    if self.ready:
+                        item, delay = SCHEDULER.poll(self.assigned)
+                    else:
+                        item, delay = None, None
+                    if item:
+                        break
+                    SCHEDULER.condition.wait(delay)
+            channel, message, delivered = item
+            try:
+                self.join(channel)
+                self.ws.send(f"PRIVMSG #{channel} :{message}")
+                LOGGER.info(f"PRIVMSG #{channel} :{message}")
+            except WebSocketException as e:
+                # put the message back so the next connection can deliver it
+                LOGGER.error(f"Could not send chat message: {e}")
+                SCHEDULER.requeue(channel, message, delivered)
+                self.close()
+                return
+            SCHEDULER.delivered()
+            metrics.increment("chat_sends")
+            delivered.set()
+
+
+class ChatGateway:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = []
+        self.assignments = {}
+        self.access_token = None
+
+    def prune(self):
+        # caller must hold the lock; channels of dropped connections get reassigned
+        for connection in [x for x in self.connections if x.closed]:
+            self.connections.remove(connection)
+            for channel in connection.assigned:
+                self.assignments.pop(channel, None)
+
+    def place(self, channel, username, access_token):
+        # caller must hold the lock; picks the least-loaded shard with room
+        available = [
+            x for x in self.connections if len(x.assigned) < CHAT_CHANNELS_PER_SHARD
+        ]
+        if available:
+            connection = min(available, key=lambda x: len(x.assigned))
+        elif len(self.connections) < CHAT_MAX_CONNECTIONS:
+            connection = ChatConnection(username, access_token)
+            self.connections.append(connection)
+        else:
+            LOGGER.warning(f"All chat connections are full; adding #{channel}")
+            connection = min(self.connections, key=lambda x: len(x.assigned))
+        connection.assign(channel)
+        self.assignments[channel] = connection
+        return connection
+
+    def connection_for(self, channel, username, access_token):
+        with self.lock:
+            if access_token != self.access_token:
+                # the token rotated; undelivered messages stay queued in the scheduler
+                for connection in self.connections:
+                    connection.close()
+                self.access_token = access_token
+            self.prune()
+            with SCHEDULER.condition:
+                orphaned = [x for x in SCHEDULER.pending if x not in self.assignments]
+            for pending_channel in orphaned:
+                self.place(pending_channel, username, access_token)
+            connection = self.assignments.get(channel)
+            if connection is None:
+                connection = self.place(channel, username, access_token)
+            return connection
+
+    def send(self, username, channel, message, access_token):
+        self.connection_for(channel, username, access_token)
+        return SCHEDULER.submit(channel, message)
+
+    def flush(self, timeout):
+        with self.lock:
+            connections = list(self.connections)
+        if not connections:
+            return True
+        with SCHEDULER.condition:
+            SCHEDULER.condition.wait_for(
+                lambda: all(x.closed for x in connections) or SCHEDULER.idle(),
+                timeout,
+            )
+            return SCHEDULER.idle()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "connections": len(self.connections),
+                "channels": [len(x.assigned) for x in self.connections],
+            }
+
+
+GATEWAY = ChatGateway()
+
+
+def send_message(username, channel, message, access_token):
+    return GATEWAY.send(username, channel, message, access_token)
+
+
+def flush(timeout=CHAT_FLUSH_TIMEOUT):
+    return GATEWAY.flush(timeout)
@@ -0,0 +1,31 @@
+import os
+import threading
+
+from google.cloud import firestore
+
+PREWARM = os.getenv("PREWARM", "true").lower() == "true"
+
+CLIENT = None
+CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    # one client (and gRPC channel) per process, created on first use
+    global CLIENT
+    if CLIENT is None:
+        with CLIENT_LOCK:
+            if CLIENT is None:
+                CLIENT = firestore.Client()
+    return CLIENT
+
+
+def adopt_legacy(collection, document_id, field, operator, value, key=None):
+    # records from before deterministic ids are found by query and copied under
+    # the new id; migrate.py merges and deletes the originals
+    db = get_client()
+    documents = db.collection(collection).where(field, operator, value).get()
+    if not documents:
+        return None
+    data = max(documents, key=key).to_dict() if key else documents[0].to_dict()
+    db.collection(collection).document(document_id).set(data)
+    return data
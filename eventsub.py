@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from websocket import WebSocketApp
+
+import database
+import twitch
+import webhook
+from tokens import lookup_token
+
+EVENTSUB_WS_URI = os.getenv("EVENTSUB_WS_URI", "wss://eventsub.wss.twitch.tv/ws")
+EVENTSUB_WORKERS = int(os.getenv("EVENTSUB_WORKERS", 4))
+EVENTSUB_RECONNECT_DELAY = float(os.getenv("EVENTSUB_RECONNECT_DELAY", 5))
+EVENTSUB_KEEPALIVE_GRACE = float(os.getenv("EVENTSUB_KEEPALIVE_GRACE", 5))
+EVENT_TYPE = "channel.channel_points_custom_reward_redemption.add"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+
+class EventSubSession:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=EVENTSUB_WORKERS)
+        self.session_id = None
+        self.subscriptions = {}
+        self.broadcaster_ids = set()
+        self.keepalive_timeout = 10
+        self.dropped = threading.Event()
+        self.replacement = None
+        self.ws = None
+
+    def run(self):
+        # the listener keeps the subscribed set in step with _select's records
+        db = database.get_client()
+        db.collection("subscriptions").on_snapshot(self.on_subscriptions)
+        threading.Thread(target=self.watch, daemon=True).start()
+        while True:
+            # a fresh session starts without any of the old subscriptions
+            with self.lock:
+                self.subscriptions = {}
+            self.dropped.clear()
+            self.replacement = None
+            self.ws = self.connect(EVENTSUB_WS_URI)
+            self.dropped.wait()
+            self.session_id = None
+            time.sleep(EVENTSUB_RECONNECT_DELAY)
+
+    def connect(self, uri):
+        ws = WebSocketApp(
+            uri,
+            on_message=self.on_message,
+            on_error=self.on_error,
+            on_close=self.on_close,
+        )
+        ws.last_message = time.monotonic()
+        threading.Thread(target=self.serve, args=(ws,), daemon=True).start()
+        return ws
+
+    def serve(self, ws):
+        ws.run_forever()
+        # a socket retired by a reconnect is expected to close; the active one is not
+        if ws is self.ws:
+            self.dropped.set()
+
+    def watch(self):
+        # twitch sends keepalives, so silence past the timeout means a dead socket
+        while True:
+            time.sleep(1)
+            ws = self.ws
+            timeout = self.keepalive_timeout + EVENTSUB_KEEPALIVE_GRACE
+            if ws is not None and time.monotonic() - ws.last_message > timeout:
+                LOGGER.warning("EventSub keepalive timed out, reconnecting")
+                ws.last_message = time.monotonic()
+                ws.close()
+
+    def on_message(self, ws, message):
+        ws.last_message = time.monotonic()
+        data = json.loads(message)
+        metadata = data.get("metadata", {})
+        payload = data.get("payload", {})
+        message_type = metadata.get("message_type")
+        if message_type == "session_welcome":
+            session = payload.get("session", {})
+            self.keepalive_timeout = session.get("keepalive_timeout_seconds") or 10
+            self.session_id = session.get("id")
+            LOGGER.info(f"EventSub session {self.session_id} started")
+            if ws is self.replacement:
+                # subscriptions carried over, so only the old socket needs retiring
+                previous, self.ws, self.replacement = self.ws, ws, None
+                previous.close()
+            else:
+                self.sync()
+        elif message_type == "notification":
+            self.on_notification(metadata, payload.get("event", {}))
+        elif message_type == "session_reconnect":
+            # keep reading the old socket until the new one has been welcomed
+            LOGGER.info("EventSub session asked to reconnect")
+            reconnect_uri = payload.get("session", {}).get("reconnect_url")
+            self.replacement = self.connect(reconnect_uri)
+        elif message_type == "revocation":
+            subscription = payload.get("subscription", {})
+            LOGGER.warning(f"EventSub subscription revoked: {subscription}")
+            condition = subscription.get("condition", {})
+            broadcaster_id = condition.get("broadcaster_user_id")
+            with self.lock:
+                self.subscriptions.pop(broadcaster_id, None)
+
+    def on_error(self, ws, error):
+        LOGGER.error(f"Error in EventSub websocket: {error}")
+
+    def on_close(self, ws, *args):
+        LOGGER.info("EventSub websocket closed")
+
+    def on_notification(self, metadata, event):
+        message_id = metadata.get("message_id")
+        if webhook.is_duplicate(message_id):
+            LOGGER.info(f"Ignoring duplicate delivery of {message_id}")
+            return
+        message_time = webhook.parse_timestamp(metadata.get("message_timestamp"))
+        if not webhook.remember_message(message_id, message_time):
+            return
+        broadcaster_id = event.get("broadcaster_user_id")
+        subscription = webhook.get_active_subscription(broadcaster_id)
+        if webhook.reward_connected(event, subscription):
+            self.executor.submit(webhook.run_redemption, event, message_id)
+
+    def on_subscriptions(self, snapshot, changes, read_time):
+        with self.lock:
+            self.broadcaster_ids = {x.id for x in snapshot}
+        self.sync()
+
+    def sync(self):
+        if not self.session_id:
+            return
+        with self.lock:
+            wanted = set(self.broadcaster_ids)
+            current = dict(self.subscriptions)
+        for broadcaster_id in wanted - set(current):
+            self.subscribe(broadcaster_id)
+        for broadcaster_id in set(current) - wanted:
+            self.unsubscribe(broadcaster_id, current[broadcaster_id])
+
+    def subscribe(self, broadcaster_id):
+        # websocket transports must be authorized with the broadcaster's user token
+        data = {
+            "type": EVENT_TYPE,
+            "version": "1",
+            "condition": {"broadcaster_user_id": broadcaster_id},
+            "transport": {"method": "websocket", "session_id": self.session_id},
+        }
+        try:
+            access_token = lookup_token(broadcaster_id)
+            result = twitch.helix(
+                "POST", "eventsub/subscriptions", access_token, json=data
+            )
+            result.raise_for_status()
+        except Exception as e:
+            LOGGER.error(f"Could not subscribe to {broadcaster_id}: {e}")
+            return
+        subscription_id = result.json().get("data")[0].get("id")
+        with self.lock:
+            self.subscriptions[broadcaster_id] = subscription_id
+        LOGGER.info(f"Subscribed to redemptions for {broadcaster_id}")
+
+    def unsubscribe(self, broadcaster_id, subscription_id):
+        with self.lock:
+            self.subscriptions.pop(broadcaster_id, None)
+        try:
+            access_token = lookup_token(broadcaster_id)
+            params = {"id": subscription_id}
+            twitch.helix(
+                "DELETE", "eventsub/subscriptions", access_token, params=params
+            )
+        except Exception as e:
+            LOGGER.error(f"Could not unsubscribe from {broadcaster_id}: {e}")
+
+
+def main():
+    EventSubSession().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,79 @@
 #!/usr/bin/env python
+import argparse
 import csv
+import os
+import sys
+import time
 
-from google.cloud import firestore
+import database
+from quotes import build_index, publish_metadata
 
-# configure this variable to indicate which line to begin the import
-# note that for all intents and purposes, the header line is line 0
-STARTING_LINE = 1
 
-# configure this variable to indicate which ID to start inserting at
-# for the first run, make sure this is set to 1
-STARTING_ID = 1
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as fh:
+        return int(fh.read().strip() or 0)
 
-db = firestore.Client()
-quotes = db.collection("lotr-quotes")
-id = STARTING_ID
-line_no = 1
 
-with open("quotes.csv") as fh:
-    reader = csv.DictReader(fh)
-    for row in reader:
-        if line_no >= STARTING_LINE:
+def write_checkpoint(path, line_no):
+    # write-then-rename so an interrupted run never leaves a torn checkpoint
+    with open(path + ".tmp", "w") as fh:
+        fh.write(str(line_no))
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import quotes into Firestore")
+    parser.add_argument("--file", default="quotes.csv")
+    parser.add_argument("--collection", default="lotr-quotes")
+    parser.add_argument("--checkpoint", default="insert.checkpoint")
+    parser.add_argument("--starting-id", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--restart", action="store_true")
+    parser.add_argument("--max-attempts", type=int, default=15)
+    parser.add_argument(
+        "--index", help="compile a local sqlite index here instead of importing"
+    )
+    args = parser.parse_args()
+
+    if args.index:
+        started = time.monotonic()
+        count = build_index(args.file, args.index)
+        elapsed = time.monotonic() - started
+        size = os.path.getsize(args.index)
+        print(f"Compiled {count} quotes into {args.index} ({size} bytes)")
+        print(f"Took {elapsed:.2f}s")
+        return
+
+    # the header line is line 0, so line N holds quote id STARTING_ID + N - 1
+    resume_after = 0 if args.restart else read_checkpoint(args.checkpoint)
+    if resume_after:
+        print(f"Resuming after line {resume_after}")
+
+    db = database.get_client()
+    quotes = db.collection(args.collection)
+    writer = db.bulk_writer()
+    failures = []
+
+    def on_write_error(error, bulk_writer):
+        # retry like the default handler, but remember writes that finally gave up
+        if error.attempts < args.max_attempts:
+            return True
+        failures.append(error)
+        return False
+
+    writer.on_write_error(on_write_error)
+    written = 0
+    line_no = 0
+    started = time.monotonic()
+
+    with open(args.file, newline="") as fh:
+        reader = csv.DictReader(fh)
+        for line_no, row in enumerate(reader, start=1):
+            if line_no <= resume_after:
+                continue
+            id = args.starting_id + line_no - 1
             entry = {
                 "id": id,
                 "quote": row.get("Quote"),
@@ -27,8 +81,35 @@ with open("quotes.csv") as fh:
                 "source_type": row.get("Type"),
                 "speaker": row.get("Speaker"),
             }
-            quotes.add(entry)
-            id += 1
-        line_no += 1
+            # deterministic document ids make re-running the import idempotent
+            writer.set(quotes.document(str(id)), entry)
+            written += 1
+            if written % args.chunk_size == 0:
+                writer.flush()
+                if failures:
+                    break
+                write_checkpoint(args.checkpoint, line_no)
+                elapsed = time.monotonic() - started
+                print(f"{written} quotes written ({written / elapsed:.1f}/s)")
+
+    writer.close()
+    if failures:
+        # the checkpoint and metadata only ever describe rows that landed
+        for failure in failures[:10]:
+            print(f"Write failed ({failure.code}): {failure.message}")
+        sys.exit(f"{len(failures)} quotes failed to write; re-run to resume")
+
+    # publishing new metadata is what makes running webhooks pick up the import
+    last_id = args.starting_id + line_no - 1
+    min_id, max_id = publish_metadata(db, args.collection, args.starting_id, last_id)
+    # a finished import starts over next time, so edits to the csv are picked up
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    elapsed = time.monotonic() - started
+    rate = written / elapsed if elapsed else 0.0
+    print(f"Wrote {written} quotes in {elapsed:.2f}s ({rate:.1f}/s)")
+    print(f"Quote ids {min_id}-{max_id} are live")
+
 
-print(f"Last ID: {id}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_ENDPOINT = os.getenv("METRICS_ENDPOINT", "false").lower() == "true"
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "chatbot")
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+LOCK = threading.Lock()
+COUNTERS = {}
+TIMINGS = {}
+
+# spans are attached to the current trace, which is per thread and per asyncio task
+TRACE = contextvars.ContextVar("trace", default=None)
+
+
+def increment(name, amount=1):
+    if not METRICS_ENABLED:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+    current = TRACE.get()
+    if current is not None:
+        current[1][name] = current[1].get(name, 0) + amount
+
+
+def record(stage, elapsed):
+    if not METRICS_ENABLED:
+        return
+    with LOCK:
+        count, total, slowest = TIMINGS.get(stage, (0, 0.0, 0.0))
+        TIMINGS[stage] = (count + 1, total + elapsed, max(slowest, elapsed))
+    current = TRACE.get()
+    if current is not None:
+        current[0][stage] = current[0].get(stage, 0.0) + elapsed * 1000
+
+
+@contextmanager
+def span(stage):
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+@contextmanager
+def trace(name, **fields):
+    # nested traces fold into the outermost one so each request logs a single line
+    if not METRICS_ENABLED or TRACE.get() is not None:
+        with span(name):
+            yield
+        return
+    spans, counters = {}, {}
+    token = TRACE.set((spans, counters))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        TRACE.reset(token)
+        record(name, elapsed)
+        record_data = {
+            "trace": name,
+            "total_ms": round(elapsed * 1000, 3),
+            "spans": {x: round(y, 3) for x, y in spans.items()},
+            "counters": counters,
+            **fields,
+        }
+        LOGGER.info(json.dumps(record_data))
+
+
+def snapshot():
+    with LOCK:
+        return dict(COUNTERS), dict(TIMINGS)
+
+
+def render():
+    # prometheus text exposition format, version 0.0.4
+    counters, timings = snapshot()
+    lines = []
+    for name, value in sorted(counters.items()):
+        metric = f"{METRICS_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    metric = f"{METRICS_PREFIX}_stage_seconds"
+    if timings:
+        lines.append(f"# TYPE {metric} summary")
+    for stage, (count, total, slowest) in sorted(timings.items()):
+        lines.append(f'{metric}_count{{stage="{stage}"}} {count}')
+        lines.append(f'{metric}_sum{{stage="{stage}"}} {total:.6f}')
+    if timings:
+        lines.append(f"# TYPE {metric}_max gauge")
+    for stage, (count, total, slowest) in sorted(timings.items()):
+        lines.append(f'{metric}_max{{stage="{stage}"}} {slowest:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+def handler(request):
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+from collections import defaultdict
+
+import database
+from quotes import QUOTE_COLLECTION, publish_metadata
+from tokens import APP_DOCUMENT_ID, token_document_ids
+
+
+def migrate_subscriptions(db):
+    # collapse query-keyed subscription records into one document per broadcaster
+    subscriptions = db.collection("subscriptions")
+    records = defaultdict(list)
+    for document in subscriptions.stream():
+        records[document.to_dict().get("broadcaster_id")].append(document)
+
+    for broadcaster_id, documents in records.items():
+        if not broadcaster_id:
+            continue
+        if [x.id for x in documents] == [broadcaster_id]:
+            continue
+        data = [x.to_dict() for x in documents]
+        merged = next((x for x in data if x.get("subscription_id")), data[0]).copy()
+        reward_ids = {y for x in data for y in x.get("reward_ids", [])}
+        merged["reward_ids"] = sorted(reward_ids)
+        subscriptions.document(broadcaster_id).set(merged)
+        for document in documents:
+            if document.id != broadcaster_id:
+                document.reference.delete()
+        orphans = {x.get("subscription_id") for x in data} - {
+            merged.get("subscription_id"),
+            None,
+        }
+        for subscription_id in orphans:
+            print(f"Orphaned EventSub subscription {subscription_id}; delete it")
+        print(f"Migrated {len(documents)} subscription records for {broadcaster_id}")
+
+
+def migrate_tokens(db):
+    # keep the newest token per role and move it under its deterministic id
+    tokens = db.collection("auth-tokens")
+    latest = {}
+    legacy = []
+    for document in tokens.stream():
+        token_data = document.to_dict()
+        if document.id == APP_DOCUMENT_ID or "refresh_token" not in token_data:
+            continue
+        document_ids = token_document_ids(
+            token_data.get("scopes", []), token_data.get("broadcaster_id")
+        )
+        if document.id in document_ids:
+            continue
+        legacy.append(document)
+        for document_id in document_ids:
+            current = latest.get(document_id)
+            if not current or current["expires_at"] < token_data["expires_at"]:
+                latest[document_id] = token_data
+
+    for document_id, token_data in latest.items():
+        existing = tokens.document(document_id).get()
+        if existing.exists and existing.get("expires_at") >= token_data["expires_at"]:
+            continue
+        tokens.document(document_id).set(token_data)
+        print(f"Stored token {document_id}")
+    for document in legacy:
+        document.reference.delete()
+    print(f"Removed {len(legacy)} legacy token records")
+
+
+def migrate_quotes(db, collection=QUOTE_COLLECTION):
+    # re-key quotes imported with add() by their id field and publish the metadata
+    quotes = db.collection(collection)
+    ids = set()
+    moved = 0
+    for document in quotes.stream():
+        entry = document.to_dict()
+        id = entry.get("id")
+        if id is None:
+            print(f"Quote {document.id} has no id; skipping it")
+            continue
+        ids.add(id)
+        if document.id == str(id):
+            continue
+        quotes.document(str(id)).set(entry)
+        document.reference.delete()
+        moved += 1
+    print(f"Re-keyed {moved} quotes")
+    if not ids:
+        return
+    min_id, max_id = min(ids), max(ids)
+    missing = max_id - min_id + 1 - len(ids)
+    if missing:
+        print(f"{missing} quote ids between {min_id} and {max_id} are missing")
+    min_id, max_id = publish_metadata(db, collection, min_id, max_id)
+    print(f"Quote ids {min_id}-{max_id} are live")
+
+
+def main():
+    db = database.get_client()
+    migrate_subscriptions(db)
+    migrate_tokens(db)
+    migrate_quotes(db)
+
+
+if __name__ == "__main__":
+    main()
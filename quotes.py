@@ -0,0 +1,286 @@
+import csv
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from google.cloud import firestore
+
+import database
+import metrics
+
+QUOTE_COLLECTION = os.getenv("QUOTE_COLLECTION", "lotr-quotes")
+QUOTE_CACHE_TTL = int(os.getenv("QUOTE_CACHE_TTL", 60))
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", 10000))
+QUOTE_STORE = os.getenv("QUOTE_STORE", "firestore")
+QUOTE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+QUOTE_INDEX = os.getenv("QUOTE_INDEX", os.path.join(QUOTE_DIRECTORY, "quotes.db"))
+QUOTE_SOURCE = os.getenv("QUOTE_SOURCE", os.path.join(QUOTE_DIRECTORY, "quotes.csv"))
+FILTER_COLUMNS = ("speaker", "source", "source_type")
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+CACHE_LOCK = threading.Lock()
+QUOTES = ()
+FILTERS = None
+METADATA = None
+VERSION = None
+CHECKED_AT = None
+UNVERSIONED = "unversioned"
+
+INDEX_LOCK = threading.Lock()
+INDEX_PATH = None
+INDEX_COUNT = None
+INDEX_LOCAL = threading.local()
+
+
+def format_quote(quote_data):
+    return quote_data.get("quote") + " -" + quote_data.get("speaker")
+
+
+def normalize(value):
+    return " ".join(str(value).split()).casefold()
+
+
+class QuoteFilters:
+    # inverted indexes from each normalized column value to the matching quote keys
+    def __init__(self, rows, lines=None):
+        self.lines = lines
+        self.columns = {x: {} for x in FILTER_COLUMNS}
+        self.matches = {}
+        for key, *values in rows:
+            for column, value in zip(FILTER_COLUMNS, values):
+                if value:
+                    self.columns[column].setdefault(normalize(value), []).append(key)
+
+    def keys(self, filters):
+        # each distinct filter is intersected once, so later picks are O(1)
+        criteria = tuple(
+            sorted(
+                (x, normalize(y))
+                for x, y in filters.items()
+                if x in FILTER_COLUMNS and y
+            )
+        )
+        if not criteria:
+            return None
+        keys = self.matches.get(criteria)
+        if keys is None:
+            matches = [set(self.columns[x].get(y, ())) for x, y in criteria]
+            keys = tuple(sorted(set.intersection(*matches)))
+            self.matches[criteria] = keys
+        return keys
+
+    def choose(self, filters):
+        keys = self.keys(filters) if filters else None
+        if keys is None:
+            return None
+        if not keys:
+            LOGGER.warning(f"No quotes match {filters}, picking from all quotes")
+            return None
+        return random.choice(keys)
+
+
+def load_metadata():
+    # maintained by insert.py: count, min_id, max_id and a version bumped per import
+    db = database.get_client()
+    document = db.collection("quote-metadata").document(QUOTE_COLLECTION).get()
+    metrics.increment("firestore_reads")
+    return document.to_dict() if document.exists else None
+
+
+@firestore.transactional
+def merge_metadata(transaction, reference, min_id, max_id):
+    snapshot = reference.get(transaction=transaction)
+    if snapshot.exists:
+        current = snapshot.to_dict()
+        min_id = min(min_id, current.get("min_id", min_id))
+        max_id = max(max_id, current.get("max_id", max_id))
+    transaction.set(
+        reference,
+        {
+            "count": max_id - min_id + 1,
+            "min_id": min_id,
+            "max_id": max_id,
+            "version": firestore.Increment(1),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
+    return min_id, max_id
+
+
+def publish_metadata(db, collection, min_id, max_id):
+    # widen the published range so an append run never hides the earlier ids
+    reference = db.collection("quote-metadata").document(collection)
+    return merge_metadata(db.transaction(), reference, min_id, max_id)
+
+
+def load_quotes(metadata):
+    db = database.get_client()
+    result = db.collection(QUOTE_COLLECTION)
+    if metadata:
+        result = result.where("id", ">=", metadata.get("min_id")).where(
+            "id", "<=", metadata.get("max_id")
+        )
+    result = result.limit(QUOTE_CACHE_MAX_ENTRIES)
+    documents = [x.to_dict() for x in result.stream()]
+    metrics.increment("firestore_reads", max(len(documents), 1))
+    # only the formatted chat line is kept, so the cache stays small
+    quotes = tuple(format_quote(x) for x in documents)
+    filters = QuoteFilters(
+        ((i, *(x.get(y) for y in FILTER_COLUMNS)) for i, x in enumerate(documents)),
+        lines=quotes,
+    )
+    return quotes, filters
+
+
+def refresh_quotes():
+    global QUOTES, FILTERS, METADATA, VERSION, CHECKED_AT
+    now = time.monotonic()
+    if CHECKED_AT is not None and now - CHECKED_AT < QUOTE_CACHE_TTL:
+        return
+    with CACHE_LOCK:
+        if CHECKED_AT is not None and now - CHECKED_AT < QUOTE_CACHE_TTL:
+            return
+        try:
+            metadata = load_metadata()
+            if not metadata:
+                if VERSION != UNVERSIONED:
+                    # quotes imported before the metadata existed; run migrate.py
+                    LOGGER.warning("Quote metadata is missing, loading the collection")
+                    quotes, FILTERS = load_quotes(None)
+                    QUOTES = quotes
+                    LOGGER.info(f"Loaded {len(QUOTES)} quotes")
+                    VERSION = UNVERSIONED
+            elif metadata.get("version") != VERSION:
+                if metadata.get("count", 0) <= QUOTE_CACHE_MAX_ENTRIES:
+                    quotes, FILTERS = load_quotes(metadata)
+                    QUOTES = quotes
+                    LOGGER.info(f"Loaded {len(QUOTES)} quotes")
+                else:
+                    # too large to hold in memory, so fall back to one read per pick
+                    QUOTES, FILTERS = (), None
+                VERSION = metadata.get("version")
+            METADATA = metadata
+        except Exception as e:
+            # keep serving the stale corpus rather than failing the redemption
+            if not QUOTES and METADATA is None:
+                raise
+            LOGGER.error(f"Could not refresh quotes: {e}")
+        CHECKED_AT = now
+
+
+def invalidate_quotes():
+    global VERSION, CHECKED_AT
+    with CACHE_LOCK:
+        VERSION = None
+        CHECKED_AT = None
+
+
+def build_index(source_path, index_path):
+    # ids are dense from 1, so a pick is one primary key lookup
+    temporary_path = index_path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    with open(source_path, newline="") as fh:
+        rows = [
+            (
+                id,
+                format_quote({"quote": x.get("Quote"), "speaker": x.get("Speaker")}),
+                x.get("Speaker"),
+                x.get("Source"),
+                x.get("Type"),
+            )
+            for id, x in enumerate(csv.DictReader(fh), start=1)
+        ]
+    connection = sqlite3.connect(temporary_path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE quotes (id INTEGER PRIMARY KEY, line TEXT NOT NULL, "
+            "speaker TEXT, source TEXT, source_type TEXT)"
+        )
+        connection.executemany("INSERT INTO quotes VALUES (?, ?, ?, ?, ?)", rows)
+    connection.execute("VACUUM")
+    connection.close()
+    # rename last so readers never open a half-written index
+    os.replace(temporary_path, index_path)
+    return len(rows)
+
+
+def connect_index(path):
+    # immutable skips file locking entirely since nothing writes to the index
+    return sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+
+
+def open_index():
+    global INDEX_PATH, INDEX_COUNT, FILTERS
+    if INDEX_PATH is None:
+        with INDEX_LOCK:
+            if INDEX_PATH is None:
+                path = QUOTE_INDEX
+                if not os.path.exists(path):
+                    # terraform can only bundle text, so compile the csv on cold start
+                    path = os.path.join(tempfile.gettempdir(), "quotes.db")
+                    count = build_index(QUOTE_SOURCE, path)
+                    LOGGER.info(f"Compiled {count} quotes into {path}")
+                connection = connect_index(path)
+                result = connection.execute("SELECT MAX(id) FROM quotes")
+                INDEX_COUNT = result.fetchone()[0]
+                columns = ", ".join(FILTER_COLUMNS)
+                result = connection.execute(f"SELECT id, {columns} FROM quotes")
+                FILTERS = QuoteFilters(result)
+                connection.close()
+                INDEX_PATH = path
+    # sqlite connections are not shared across threads, so each gets its own
+    connection = getattr(INDEX_LOCAL, "connection", None)
+    if connection is None:
+        connection = INDEX_LOCAL.connection = connect_index(INDEX_PATH)
+    return connection
+
+
+def get_indexed_quote(filters=None):
+    connection = open_index()
+    if not INDEX_COUNT:
+        return None
+    random_id = FILTERS.choose(filters) or random.randint(1, INDEX_COUNT)
+    result = connection.execute("SELECT line FROM quotes WHERE id = ?", (random_id,))
+    row = result.fetchone()
+    return row[0] if row else None
+
+
+def quote_ready():
+    # true when a pick is served from memory or the local index without firestore
+    if QUOTE_STORE == "sqlite":
+        return INDEX_PATH is not None
+    fresh = CHECKED_AT is not None and time.monotonic() - CHECKED_AT < QUOTE_CACHE_TTL
+    return fresh and bool(QUOTES)
+
+
+def get_random_quote(filters=None):
+    if QUOTE_STORE == "sqlite":
+        return get_indexed_quote(filters)
+    refresh_quotes()
+    quotes, quote_filters, metadata = QUOTES, FILTERS, METADATA
+    if quote_filters:
+        # the filters carry their own corpus so a concurrent reload cannot skew keys
+        key = quote_filters.choose(filters)
+        if key is not None:
+            return quote_filters.lines[key]
+    if quotes:
+        return random.choice(quotes)
+    if filters:
+        LOGGER.info("Quote filters need the in-memory corpus, picking from all quotes")
+    if not metadata or not metadata.get("count"):
+        return None
+    # ids are dense between min_id and max_id, so a single read always hits
+    random_id = random.randint(metadata.get("min_id"), metadata.get("max_id"))
+    db = database.get_client()
+    document = db.collection(QUOTE_COLLECTION).document(str(random_id)).get()
+    metrics.increment("firestore_reads")
+    return format_quote(document.to_dict()) if document.exists else None
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+from aiohttp import web
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+import _select
+import auth
+import chat
+import metrics
+import quotes
+import tokens
+import webhook
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("PORT", 8080))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 8))
+FULFILLMENT_BATCH_WINDOW = float(os.getenv("FULFILLMENT_BATCH_WINDOW", 1))
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+# this process keeps running after each response, so timers can batch fulfillments
+webhook.FULFILLMENT_BATCH_WINDOW = FULFILLMENT_BATCH_WINDOW
+
+# the handlers build some responses with flask.jsonify, which needs an app context
+FLASK_APP = flask.Flask(__name__)
+
+# low-traffic pages keep their blocking handlers and run on the small pool
+ROUTES = {
+    "auth": auth.handler,
+    "select": _select.handler,
+}
+
+
+class Request:
+    # the subset of flask's request that the function handlers read
+    def __init__(self, request, path, data):
+        self.args = request.query
+        self.headers = request.headers
+        self.path = path or "/"
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+
+def call_handler(handler, request):
+    with FLASK_APP.app_context():
+        return handler(request)
+
+
+def to_response(result):
+    body, status, headers = result, 200, {}
+    if isinstance(result, tuple):
+        body, status, headers = (result + ({},))[:3]
+    headers = dict(headers)
+    if isinstance(body, flask.Response):
+        headers = {**dict(body.headers), **headers}
+        body = body.get_data()
+    headers.pop("Content-Length", None)
+    if isinstance(body, str):
+        headers.setdefault("Content-Type", "text/html; charset=utf-8")
+        body = body.encode("utf-8")
+    return web.Response(body=body, status=status, headers=headers)
+
+
+async def blocking(app, function, *args):
+    # copy the context so spans recorded on the pool land in the request's trace
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(app["executor"], context.run, function, *args)
+
+
+async def dispatch(request):
+    handler = ROUTES[request.match_info["function"]]
+    shim = Request(request, request.match_info["path"], await request.read())
+    try:
+        result = await blocking(request.app, call_handler, handler, shim)
+    except Exception:
+        LOGGER.exception(f"Unhandled error in {request.path}")
+        return web.Response(text="Internal server error", status=500)
+    return to_response(result)
+
+
+# the webhook hot path runs on the event loop with the async firestore client and
+# shares its decisions with webhook.py; only cache misses fall back to the pool
+
+
+async def get_subscription(app, broadcaster_id, refresh=False):
+    subscription = None if refresh else webhook.cached_subscription(broadcaster_id)
+    if subscription:
+        return subscription
+    loaded_at = time.monotonic()
+    reference = app["db"].collection("subscriptions").document(broadcaster_id)
+    document = await reference.get()
+    metrics.increment("firestore_reads")
+    if document.exists:
+        subscription = document.to_dict()
+    else:
+        # records from before migrate.py ran need a query, so use the pool
+        subscription = await blocking(
+            app, webhook.load_legacy_subscription, broadcaster_id
+        )
+        if not subscription:
+            return None
+    webhook.cache_subscription(broadcaster_id, subscription, loaded_at)
+    return subscription
+
+
+async def remember_message(app, message_id, message_time):
+    if not webhook.claim_message(message_id, message_time):
+        return False
+    if webhook.DEDUP_BACKEND != "firestore":
+        return True
+    reference = app["db"].collection("eventsub-messages").document(message_id)
+    try:
+        await reference.create(webhook.message_record(message_time))
+        metrics.increment("firestore_writes")
+    except AlreadyExists:
+        return False
+    except Exception:
+        webhook.release_message(message_id)
+        raise
+    return True
+
+
+async def forget_message(app, message_id):
+    webhook.release_message(message_id)
+    if webhook.DEDUP_BACKEND == "firestore":
+        reference = app["db"].collection("eventsub-messages").document(message_id)
+        await reference.delete()
+        metrics.increment("firestore_writes")
+
+
+def redemption_ready():
+    # a warm quote corpus and chat token mean a redemption never touches firestore
+    chat_token = tokens.cached_token(tokens.CHAT_BOT_DOCUMENT_ID)
+    return quotes.quote_ready() and chat_token is not None
+
+
+async def process_redemption(app, event, subscription):
+    if redemption_ready():
+        webhook.process_redemption(event, subscription)
+    else:
+        await blocking(app, webhook.process_redemption, event, subscription)
+
+
+async def handle_webhook(request, message_id, message_type):
+    app = request.app
+    timestamp = request.headers.get("Twitch-Eventsub-Message-Timestamp")
+    message_time, response = webhook.check_headers(message_id, message_type, timestamp)
+    if response:
+        return to_response(response)
+    request_data = await request.read()
+    payload, event, broadcaster_id = webhook.parse_payload(request_data)
+
+    with metrics.span("subscription"):
+        subscription = await get_subscription(app, broadcaster_id)
+    if not subscription:
+        LOGGER.error("Unable to find active subscription")
+        return to_response(("Invalid subscription", 404))
+
+    signature = request.headers.get("Twitch-Eventsub-Message-Signature", "")
+    args = (message_id, timestamp, request_data, signature)
+    with metrics.span("signature"):
+        verified = webhook.subscription_verified(subscription, *args)
+    if not verified:
+        # the cached secret may be stale, so re-read the subscription once
+        subscription = await get_subscription(app, broadcaster_id, refresh=True)
+        if not webhook.subscription_verified(subscription, *args):
+            response = webhook.signature_mismatch(
+                message_id, signature, broadcaster_id, request.headers
+            )
+            return to_response(response)
+
+    response = webhook.route_message(message_type, payload)
+    if response:
+        return to_response(response)
+    if not await remember_message(app, message_id, message_time):
+        LOGGER.info(f"Ignoring duplicate delivery of {message_id}")
+        return to_response(("", 204))
+    if webhook.reward_connected(event, subscription):
+        if webhook.WEBHOOK_ASYNC:
+            webhook.enqueue_redemption(event, message_id)
+        else:
+            try:
+                await process_redemption(app, event, subscription)
+            except Exception:
+                # let twitch's retry through since this delivery did not land
+                await forget_message(app, message_id)
+                raise
+    return to_response(("", 204))
+
+
+async def serve_webhook(request):
+    if metrics.METRICS_ENDPOINT and request.match_info["path"] == "/metrics":
+        return await serve_metrics(request)
+    message_id = request.headers.get("Twitch-Eventsub-Message-Id")
+    message_type = request.headers.get("Twitch-Eventsub-Message-Type")
+    try:
+        with metrics.trace("webhook", message_id=message_id, message_type=message_type):
+            return await handle_webhook(request, message_id, message_type)
+    except Exception:
+        LOGGER.exception(f"Unhandled error in {request.path}")
+        return web.Response(text="Internal server error", status=500)
+
+
+async def serve_metrics(request):
+    return to_response(metrics.handler(request))
+
+
+async def startup(app):
+    # grpc's asyncio channels bind to the running loop, so build the client here
+    app["db"] = firestore.AsyncClient()
+    # a full fulfillment batch makes blocking helix calls, so keep it off the loop
+    webhook.FULFILLMENT_EXECUTOR = app["executor"]
+    webhook.LONG_LIVED = True
+    if webhook.SUBSCRIPTION_LISTENER:
+        await blocking(app, webhook.watch_subscriptions)
+
+
+async def shutdown(app):
+    # drain queued chat messages and fulfillment batches before exiting
+    await blocking(app, webhook.flush_fulfillments)
+    await blocking(app, chat.flush)
+    app["db"].close()
+    app["executor"].shutdown(wait=True)
+
+
+def make_app(workers=SERVER_WORKERS):
+    app = web.Application()
+    app["executor"] = ThreadPoolExecutor(max_workers=workers)
+    functions = "|".join(ROUTES)
+    app.router.add_route("*", f"/{{function:{functions}}}{{path:(/.*)?}}", dispatch)
+    app.router.add_route("*", "/webhook{path:(/.*)?}", serve_webhook)
+    if metrics.METRICS_ENDPOINT:
+        app.router.add_get("/metrics", serve_metrics)
+    app.on_startup.append(startup)
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve every function in one process")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    args = parser.parse_args()
+    web.run_app(make_app(args.workers), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ["auth", "_select", "webhook"]
+
+# runs in a fresh interpreter so every measurement is a true cold import
+PROBE = """
+import json, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import database
+database.get_client()
+initialized = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "init_ms": (initialized - imported) * 1000,
+}}))
+"""
+
+
+def parse_importtime(stderr, top):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        # rank the direct dependencies, i.e. imports nested exactly one level deep
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth != 1:
+            continue
+        imports.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def measure(module, top):
+    env = dict(os.environ, PREWARM="false")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module)],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if result.returncode:
+        raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings["slowest"] = parse_importtime(result.stderr, top)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report cold-start cost per function")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="fail if any module is slower")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        runs = [measure(module, args.top) for _ in range(args.runs)]
+        import_ms = min(x["import_ms"] for x in runs)
+        init_ms = min(x["init_ms"] for x in runs)
+        total_ms = import_ms + init_ms
+        print(f"{module}: import {import_ms:.1f} ms, init {init_ms:.1f} ms")
+        for cumulative_us, self_us, name in runs[-1]["slowest"]:
+            print(f"    {name:<40} {cumulative_us / 1000:8.1f} ms")
+        if args.max_ms and total_ms > args.max_ms:
+            print(f"    {total_ms:.1f} ms exceeds the {args.max_ms:.1f} ms budget")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,26 @@ data "archive_file" "auth" {
     filename = "requirements.txt"
     content  = data.template_file.files.0.rendered
   }
+
+  source {
+    filename = "database.py"
+    content  = data.template_file.files.6.rendered
+  }
+
+  source {
+    filename = "tokens.py"
+    content  = data.template_file.files.7.rendered
+  }
+
+  source {
+    filename = "twitch.py"
+    content  = data.template_file.files.8.rendered
+  }
+
+  source {
+    filename = "metrics.py"
+    content  = data.template_file.files.9.rendered
+  }
 }
 
 resource "google_storage_bucket_object" "auth" {
@@ -71,6 +91,26 @@ data "archive_file" "select" {
     filename = "requirements.txt"
     content  = data.template_file.files.0.rendered
   }
+
+  source {
+    filename = "database.py"
+    content  = data.template_file.files.6.rendered
+  }
+
+  source {
+    filename = "tokens.py"
+    content  = data.template_file.files.7.rendered
+  }
+
+  source {
+    filename = "twitch.py"
+    content  = data.template_file.files.8.rendered
+  }
+
+  source {
+    filename = "metrics.py"
+    content  = data.template_file.files.9.rendered
+  }
 }
 
 resource "google_storage_bucket_object" "select" {
@@ -93,12 +133,13 @@ resource "google_cloudfunctions_function" "select" {
   source_archive_object = google_storage_bucket_object.select.name
 
   environment_variables = {
-    CLIENT_ID     = var.client_id
-    CLIENT_SECRET = var.client_secret
-    REDIRECT_URI  = "https://${var.region}-${var.project_id}.cloudfunctions.net/auth"
-    SECRET_LENGTH = var.secret_length
-    SELECT_URI    = "https://${var.region}-${var.project_id}.cloudfunctions.net/select"
-    WEBHOOK_URI   = "https://${var.region}-${var.project_id}.cloudfunctions.net/webhook"
+    CLIENT_ID          = var.client_id
+    CLIENT_SECRET      = var.client_secret
+    EVENTSUB_TRANSPORT = var.eventsub_transport
+    REDIRECT_URI       = "https://${var.region}-${var.project_id}.cloudfunctions.net/auth"
+    SECRET_LENGTH      = var.secret_length
+    SELECT_URI         = "https://${var.region}-${var.project_id}.cloudfunctions.net/select"
+    WEBHOOK_URI        = "https://${var.region}-${var.project_id}.cloudfunctions.net/webhook"
   }
 
   depends_on = [google_project_service.build, google_project_service.functions]
@@ -123,10 +164,46 @@ data "archive_file" "webhook" {
     content  = data.template_file.files.3.rendered
   }
 
+  source {
+    filename = "chat.py"
+    content  = data.template_file.files.4.rendered
+  }
+
+  source {
+    filename = "quotes.py"
+    content  = data.template_file.files.5.rendered
+  }
+
+  # compiled into a sqlite index on cold start when QUOTE_STORE is sqlite
+  source {
+    filename = "quotes.csv"
+    content  = data.template_file.files.10.rendered
+  }
+
   source {
     filename = "requirements.txt"
     content  = data.template_file.files.0.rendered
   }
+
+  source {
+    filename = "database.py"
+    content  = data.template_file.files.6.rendered
+  }
+
+  source {
+    filename = "tokens.py"
+    content  = data.template_file.files.7.rendered
+  }
+
+  source {
+    filename = "twitch.py"
+    content  = data.template_file.files.8.rendered
+  }
+
+  source {
+    filename = "metrics.py"
+    content  = data.template_file.files.9.rendered
+  }
 }
 
 resource "google_storage_bucket_object" "webhook" {
@@ -151,9 +228,9 @@ resource "google_cloudfunctions_function" "webhook" {
   environment_variables = {
     CLIENT_ID     = var.client_id
     CLIENT_SECRET = var.client_secret
+    DEDUP_BACKEND = var.dedup_backend
+    QUOTE_STORE   = var.quote_store
     REDIRECT_URI  = "https://${var.region}-${var.project_id}.cloudfunctions.net/auth"
-    MIN_RANGE     = var.min_range
-    MAX_RANGE     = var.max_range
   }
 
   depends_on = [google_project_service.build, google_project_service.functions]
@@ -19,3 +19,19 @@ resource "google_project_service" "functions" {
   project = var.project_id
   service = "cloudfunctions.googleapis.com"
 }
+
+# expire webhook dedup records once twitch can no longer redeliver the message
+resource "google_firestore_field" "message_ttl" {
+  count      = var.dedup_backend == "firestore" ? 1 : 0
+  project    = var.project_id
+  database   = "(default)"
+  collection = "eventsub-messages"
+  field      = "expires_at"
+
+  ttl_config {}
+
+  # nothing queries by expiry, so skip the single-field indexes
+  index_config {}
+
+  depends_on = [google_project_service.firestore]
+}
@@ -4,6 +4,13 @@ locals {
     "../auth.py",
     "../_select.py",
     "../webhook.py",
+    "../chat.py",
+    "../quotes.py",
+    "../database.py",
+    "../tokens.py",
+    "../twitch.py",
+    "../metrics.py",
+    "../quotes.csv",
   ]
 }
 
@@ -22,18 +29,6 @@ variable "client_secret" {
   type        = "string"
 }
 
-variable "max_range" {
-  description = "The maximum ID in the quotes database"
-  default     = 109
-  type        = "string"
-}
-
-variable "min_range" {
-  description = "The minimum ID in the quotes database"
-  default     = 1
-  type        = "string"
-}
-
 variable "project_id" {
   description = "The name of your GCP project"
   type        = "string"
@@ -56,6 +51,39 @@ variable "secret_length" {
   }
 }
 
+variable "quote_store" {
+  default     = "firestore"
+  description = "Where the webhook picks quotes from: firestore or sqlite"
+  type        = "string"
+
+  validation {
+    condition     = contains(["firestore", "sqlite"], var.quote_store)
+    error_message = "quote_store must be firestore or sqlite"
+  }
+}
+
+variable "eventsub_transport" {
+  default     = "webhook"
+  description = "How EventSub notifications are delivered: webhook or websocket"
+  type        = "string"
+
+  validation {
+    condition     = contains(["webhook", "websocket"], var.eventsub_transport)
+    error_message = "eventsub_transport must be webhook or websocket"
+  }
+}
+
+variable "dedup_backend" {
+  default     = "memory"
+  description = "Where the webhook remembers delivered messages: memory or firestore"
+  type        = "string"
+
+  validation {
+    condition     = contains(["memory", "firestore"], var.dedup_backend)
+    error_message = "dedup_backend must be memory or firestore"
+  }
+}
+
 resource "random_string" "bucket_suffix" {
   length  = 16
   special = false
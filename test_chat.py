@@ -0,0 +1,68 @@
+import chat
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def drain(monkeypatch, channels, messages, duration, step=0.05):
+    clock = FakeClock()
+    monkeypatch.setattr(chat.time, "monotonic", clock)
+    scheduler = chat.ChatScheduler()
+    for channel in channels:
+        for n in range(messages):
+            scheduler.submit(channel, f"message {n}")
+    sends = []
+    end = clock.now + duration
+    while clock.now < end:
+        item, _ = scheduler.poll(set(channels))
+        if item:
+            sends.append((clock.now, item[0]))
+            scheduler.delivered()
+        else:
+            clock.now += step
+    return sends
+
+
+def max_in_window(times, period):
+    times = sorted(times)
+    start = 0
+    most = 0
+    for end, sent_at in enumerate(times):
+        while sent_at - times[start] >= period:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+
+def test_global_limit_holds_in_every_window(monkeypatch):
+    channels = [f"channel{x}" for x in range(10)]
+    sends = drain(monkeypatch, channels, chat.CHAT_MAX_PENDING, 120)
+    assert len(sends) > chat.CHAT_RATE_LIMIT
+    times = [x for x, _ in sends]
+    assert max_in_window(times, chat.CHAT_RATE_PERIOD) <= chat.CHAT_RATE_LIMIT
+
+
+def test_channel_limit_holds_in_every_window(monkeypatch):
+    sends = drain(monkeypatch, ["channel"], chat.CHAT_MAX_PENDING, 30)
+    assert len(sends) == chat.CHAT_MAX_PENDING
+    times = [x for x, _ in sends]
+    assert max_in_window(times, chat.CHANNEL_RATE_PERIOD) <= chat.CHANNEL_RATE_LIMIT
+
+
+def test_withdraw_drops_only_queued_messages(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(chat.time, "monotonic", clock)
+    scheduler = chat.ChatScheduler()
+    sent = scheduler.submit("channel", "first")
+    queued = scheduler.submit("channel", "second")
+    item, _ = scheduler.poll({"channel"})
+    assert item[1] == "first"
+    assert not scheduler.withdraw("channel", sent)
+    assert scheduler.withdraw("channel", queued)
+    assert scheduler.queue_depth() == 0
+    assert scheduler.dropped == 1
@@ -0,0 +1,308 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+import database
+import metrics
+import twitch
+
+REDIRECT_URI = os.getenv("REDIRECT_URI")
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 600))
+CHAT_BOT_DOCUMENT_ID = "chat-bot"
+APP_DOCUMENT_ID = "app-token"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+TOKEN_LOCK = threading.Lock()
+TOKENS = {}
+REFRESHES = {}
+TIMERS = {}
+APP_TOKEN = None
+
+
+def store_oauth_token(
+    access_token,
+    refresh_token,
+    scopes,
+    expires_at,
+    broadcaster_id,
+    username,
+    document_id,
+):
+    db = database.get_client()
+    tokens = db.collection("auth-tokens")
+    token_data = {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "scopes": scopes,
+        "expires_at": expires_at,
+        "broadcaster_id": broadcaster_id,
+        "username": username,
+    }
+    # deterministic ids make re-authorizing an upsert instead of another duplicate
+    tokens.document(document_id).set(token_data)
+    metrics.increment("firestore_writes")
+    return token_data
+
+
+def broadcaster_document_id(broadcaster_id):
+    return f"broadcaster-{broadcaster_id}"
+
+
+def token_document_ids(scopes, broadcaster_id):
+    document_ids = []
+    if "chat:edit" in scopes:
+        document_ids.append(CHAT_BOT_DOCUMENT_ID)
+    if "chat:edit" not in scopes or "channel:read:redemptions" in scopes:
+        document_ids.append(broadcaster_document_id(broadcaster_id))
+    return document_ids
+
+
+@firestore.transactional
+def replace_token(transaction, reference, refresh_token, token_data):
+    snapshot = reference.get(transaction=transaction)
+    stored = snapshot.to_dict() if snapshot.exists else None
+    if stored and stored.get("refresh_token") != refresh_token:
+        # auth.py stored a newer authorization while this refresh was in flight
+        return stored
+    transaction.set(reference, token_data)
+    return token_data
+
+
+def regenerate_token(token_data, document_id):
+    previous_refresh_token = refresh_token = token_data.get("refresh_token")
+    metrics.increment("oauth_refreshes")
+    with metrics.span("oauth_refresh"):
+        result = twitch.oauth_token(
+            {
+                "refresh_token": refresh_token,
+                "grant_type": "refresh_token",
+                "redirect_uri": REDIRECT_URI,
+            }
+        )
+    result.raise_for_status()
+    response = result.json()
+
+    # get the tokens and metadata from the oauth response
+    access_token = response.get("access_token")
+    refresh_token = response.get("refresh_token", refresh_token)
+    scopes = response.get("scope")
+    expires_in = response.get("expires_in")
+
+    # calculate the expiration timestamp
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+
+    token_data = {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "scopes": scopes,
+        "expires_at": expires_at,
+        "broadcaster_id": token_data.get("broadcaster_id"),
+        "username": token_data.get("username"),
+    }
+    db = database.get_client()
+    reference = db.collection("auth-tokens").document(document_id)
+    token_data = replace_token(
+        db.transaction(), reference, previous_refresh_token, token_data
+    )
+    metrics.increment("firestore_reads")
+    metrics.increment("firestore_writes")
+    return token_data
+
+
+def refresh_cached_token(key):
+    # single-flight: only one refresh per token runs at a time, others wait on it
+    with TOKEN_LOCK:
+        event = REFRESHES.get(key)
+        if event:
+            return event
+        event = threading.Event()
+        REFRESHES[key] = event
+        document_id = TOKENS[key][1]
+    try:
+        # start from the stored document so a re-authorization is never overwritten
+        token_data, document_id = load_token(document_id)
+        if seconds_remaining(token_data) > TOKEN_REFRESH_MARGIN:
+            LOGGER.info(f"Token {key} was refreshed or re-authorized elsewhere")
+        else:
+            LOGGER.info(f"Refreshing token {key}")
+            token_data = regenerate_token(token_data, document_id)
+        with TOKEN_LOCK:
+            TOKENS[key] = (token_data, document_id)
+        schedule_refresh(key, token_data)
+    except Exception as e:
+        LOGGER.error(f"Could not refresh token {key}: {e}")
+    finally:
+        with TOKEN_LOCK:
+            REFRESHES.pop(key, None)
+        event.set()
+    return event
+
+
+def refresh_in_background(key):
+    threading.Thread(target=refresh_cached_token, args=(key,), daemon=True).start()
+
+
+def schedule_refresh(key, token_data):
+    remaining = seconds_remaining(token_data) - TOKEN_REFRESH_MARGIN
+    timer = threading.Timer(max(remaining, 0), refresh_cached_token, args=(key,))
+    timer.daemon = True
+    with TOKEN_LOCK:
+        previous = TIMERS.pop(key, None)
+        TIMERS[key] = timer
+    if previous:
+        previous.cancel()
+    timer.start()
+
+
+def seconds_remaining(token_data):
+    now = datetime.now(timezone.utc)
+    return (token_data.get("expires_at") - now).total_seconds()
+
+
+def get_token(key, load):
+    with TOKEN_LOCK:
+        entry = TOKENS.get(key)
+    if entry is None:
+        loaded = load()
+        with TOKEN_LOCK:
+            # a concurrent caller may already have loaded (and refreshed) this token
+            entry = TOKENS.setdefault(key, loaded)
+        if entry is loaded:
+            schedule_refresh(key, entry[0])
+    remaining = seconds_remaining(entry[0])
+    if remaining <= 0:
+        # nothing usable is cached, so this request has to wait for the refresh
+        refresh_cached_token(key).wait()
+        with TOKEN_LOCK:
+            entry = TOKENS[key]
+        if seconds_remaining(entry[0]) <= 0:
+            raise RuntimeError(f"Token {key} expired and could not be refreshed")
+    elif remaining < TOKEN_REFRESH_MARGIN:
+        refresh_in_background(key)
+    return entry[0]
+
+
+def cached_token(key):
+    # the cached token when using it cannot block on firestore or oauth, else None
+    with TOKEN_LOCK:
+        entry = TOKENS.get(key)
+    if entry is None:
+        return None
+    remaining = seconds_remaining(entry[0])
+    if remaining <= 0:
+        return None
+    if remaining < TOKEN_REFRESH_MARGIN:
+        refresh_in_background(key)
+    return entry[0]
+
+
+def load_token(document_id):
+    db = database.get_client()
+    document = db.collection("auth-tokens").document(document_id).get()
+    metrics.increment("firestore_reads")
+    if document.exists:
+        return document.to_dict(), document.id
+    token_data = load_legacy_token(document_id)
+    if token_data is None:
+        raise LookupError(f"No auth token stored as {document_id}")
+    return token_data, document_id
+
+
+def load_legacy_token(document_id):
+    # tokens stored before deterministic ids keep working until migrate.py runs
+    db = database.get_client()
+    tokens = db.collection("auth-tokens")
+    if document_id == CHAT_BOT_DOCUMENT_ID:
+        query = tokens.where("scopes", "array_contains", "chat:edit")
+    else:
+        broadcaster_id = document_id.removeprefix(broadcaster_document_id(""))
+        query = tokens.where("broadcaster_id", "==", broadcaster_id)
+    matches = [x.to_dict() for x in query.get()]
+    metrics.increment("firestore_reads", max(len(matches), 1))
+    matches = [
+        x
+        for x in matches
+        if "refresh_token" in x
+        and document_id
+        in token_document_ids(x.get("scopes", []), x.get("broadcaster_id"))
+    ]
+    if not matches:
+        return None
+    token_data = max(matches, key=lambda x: x["expires_at"])
+    try:
+        # create() so a concurrent re-authorization is never overwritten
+        db.collection("auth-tokens").document(document_id).create(token_data)
+        metrics.increment("firestore_writes")
+    except AlreadyExists:
+        return load_token(document_id)[0]
+    LOGGER.warning(f"Re-keyed legacy auth token as {document_id}")
+    return token_data
+
+
+def lookup_token(broadcaster_id):
+    document_id = broadcaster_document_id(broadcaster_id)
+    token_data = get_token(document_id, lambda: load_token(document_id))
+    return token_data.get("access_token")
+
+
+def lookup_token_and_username():
+    document_id = CHAT_BOT_DOCUMENT_ID
+    token_data = get_token(document_id, lambda: load_token(document_id))
+    return token_data.get("access_token"), token_data.get("username")
+
+
+def load_app_token():
+    db = database.get_client()
+    document = db.collection("auth-tokens").document(APP_DOCUMENT_ID).get()
+    metrics.increment("firestore_reads")
+    return document.to_dict() if document.exists else None
+
+
+def generate_app_token(scopes):
+    metrics.increment("oauth_refreshes")
+    with metrics.span("oauth_refresh"):
+        result = twitch.oauth_token(
+            {"scope": " ".join(scopes), "grant_type": "client_credentials"}
+        )
+    result.raise_for_status()
+    response = result.json()
+    expires_at = datetime.now(timezone.utc) + timedelta(
+        seconds=response.get("expires_in")
+    )
+    token_data = {
+        "access_token": response.get("access_token"),
+        "scopes": scopes,
+        "expires_at": expires_at,
+    }
+    db = database.get_client()
+    db.collection("auth-tokens").document(APP_DOCUMENT_ID).set(token_data)
+    metrics.increment("firestore_writes")
+    return token_data
+
+
+def get_app_token(scopes, refresh=False):
+    # app tokens last about 60 days, so reuse one until it nears expiry or is rejected
+    global APP_TOKEN
+    with TOKEN_LOCK:
+        token_data = APP_TOKEN
+    if token_data is None and not refresh:
+        token_data = load_app_token()
+    usable = (
+        token_data
+        and not refresh
+        and set(scopes) <= set(token_data.get("scopes", []))
+        and seconds_remaining(token_data) > TOKEN_REFRESH_MARGIN
+    )
+    if not usable:
+        LOGGER.info("Generating app token")
+        token_data = generate_app_token(scopes)
+    with TOKEN_LOCK:
+        APP_TOKEN = token_data
+    return token_data.get("access_token")
@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+CLIENT_ID = os.getenv("CLIENT_ID")
+CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+TWITCH_API_URI = os.getenv("TWITCH_API_URI", "https://api.twitch.tv/helix")
+TWITCH_AUTH_URI = os.getenv("TWITCH_AUTH_URI", "https://id.twitch.tv/oauth2")
+TWITCH_TIMEOUT = float(os.getenv("TWITCH_TIMEOUT", 10))
+TWITCH_MAX_RETRIES = int(os.getenv("TWITCH_MAX_RETRIES", 3))
+TWITCH_MAX_BACKOFF = float(os.getenv("TWITCH_MAX_BACKOFF", 10))
+TWITCH_POOL_SIZE = int(os.getenv("TWITCH_POOL_SIZE", 10))
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+logging.basicConfig()
+
+# one keep-alive pool per process, shared by every helix and oauth call
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=TWITCH_POOL_SIZE))
+
+# a 5xx may arrive after twitch applied the request, so only replay safe methods
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def retry_delay(result, attempt):
+    # helix reports when the rate-limit bucket refills as an epoch timestamp
+    reset = result.headers.get("Ratelimit-Reset")
+    if result.status_code == 429 and reset:
+        delay = int(reset) - time.time()
+    else:
+        delay = 0.5 * 2 ** attempt
+    return min(max(delay, 0), TWITCH_MAX_BACKOFF)
+
+
+def request(method, url, endpoint, **kwargs):
+    for attempt in range(TWITCH_MAX_RETRIES + 1):
+        started = time.monotonic()
+        result = SESSION.request(method, url, timeout=TWITCH_TIMEOUT, **kwargs)
+        elapsed = time.monotonic() - started
+        metrics.record(f"twitch:{endpoint}", elapsed)
+        metrics.increment("twitch_requests")
+        if result.status_code != 429 and (
+            result.status_code < 500 or method.upper() not in IDEMPOTENT_METHODS
+        ):
+            break
+        if attempt < TWITCH_MAX_RETRIES:
+            delay = retry_delay(result, attempt)
+            LOGGER.warning(f"{endpoint} returned {result.status_code}, retrying")
+            time.sleep(delay)
+    return result
+
+
+def helix(method, path, access_token, params=None, json=None):
+    headers = {
+        "Client-Id": CLIENT_ID,
+        "Authorization": f"Bearer {access_token}",
+    }
+    url = f"{TWITCH_API_URI}/{path}"
+    return request(method, url, path, headers=headers, params=params, json=json)
+
+
+def oauth_token(params):
+    params = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET, **params}
+    return request("POST", f"{TWITCH_AUTH_URI}/token", "oauth2/token", params=params)
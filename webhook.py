@@ -1,267 +1,481 @@
+import base64
 import hashlib
 import hmac
+import json
 import logging
 import os
-import random
 import threading
-from datetime import datetime, timedelta
-from urllib.parse import quote_plus
-
-import pytz
-import requests
-from google.cloud import firestore
-from websocket import WebSocketApp
-
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-REDIRECT_URI = os.getenv("REDIRECT_URI")
-MIN_RANGE = int(os.getenv("MIN_RANGE", 1))
-MAX_RANGE = int(os.getenv("MAX_RANGE"))
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import AlreadyExists
+
+import chat
+import database
+import metrics
+import quotes
+import twitch
+from quotes import get_random_quote
+from tokens import lookup_token, lookup_token_and_username
+
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", 300))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 1000))
+SUBSCRIPTION_LISTENER = os.getenv("SUBSCRIPTION_LISTENER", "true").lower() == "true"
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "local")
+QUEUE_TOPIC = os.getenv("QUEUE_TOPIC")
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 600))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", 10000))
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory")
+CHAT_SEND_TIMEOUT = float(os.getenv("CHAT_SEND_TIMEOUT", 2))
+FULFILL_REDEMPTIONS = os.getenv("FULFILL_REDEMPTIONS", "false").lower() == "true"
+# functions lose their cpu after responding, so only long-lived servers batch by time
+FULFILLMENT_BATCH_WINDOW = float(os.getenv("FULFILLMENT_BATCH_WINDOW", 0))
+FULFILLMENT_BATCH_SIZE = min(int(os.getenv("FULFILLMENT_BATCH_SIZE", 50)), 50)
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 logging.basicConfig()
 
-
-def store_oauth_token(
-    access_token,
-    refresh_token,
-    scopes,
-    expires_at,
-    broadcaster_id,
-    username,
-    document_id=None,
-):
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    token_data = {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "scopes": scopes,
-        "expires_at": expires_at,
-        "broadcaster_id": broadcaster_id,
-        "username": username,
-    }
-    if document_id:
-        tokens.document(document_id).update(token_data)
-    else:
-        tokens.add(token_data)
-
-
-def regenerate_token(token_data, document_id=None):
-    refresh_token = token_data.get("refresh_token")
-    url = (
-        "https://id.twitch.tv/oauth2/token?client_id="
-        + quote_plus(CLIENT_ID)
-        + "&client_secret="
-        + quote_plus(CLIENT_SECRET)
-        + "&refresh_token="
-        + quote_plus(refresh_token)
-        + "&grant_type=refresh_token&redirect_uri="
-        + quote_plus(REDIRECT_URI)
-    )
-    result = requests.post(url)
-    result.raise_for_status()
-    response = result.json()
-
-    # get the tokens and metadata from the oauth response
-    access_token = response.get("access_token")
-    scopes = response.get("scope")
-    expires_in = response.get("expires_in")
-
-    # calculate the expiration timestamp
-    expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
-
-    broadcaster_id = token_data.get("broadcaster_id")
-    username = token_data.get("username")
-    store_oauth_token(
-        access_token,
-        refresh_token,
-        scopes,
-        expires_at,
+# build expensive clients during the cold start rather than on the first request
+if database.PREWARM:
+    database.get_client()
+    if quotes.QUOTE_STORE == "sqlite":
+        quotes.open_index()
+
+SUBSCRIPTION_CACHE = OrderedDict()
+SUBSCRIPTION_LOCK = threading.Lock()
+SUBSCRIPTION_WATCH = None
+
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+PUBLISHER = None
+
+SEEN_MESSAGES = OrderedDict()
+SEEN_LOCK = threading.Lock()
+
+FULFILLMENT_LOCK = threading.Lock()
+FULFILLMENT_BATCHES = {}
+FULFILLMENT_TIMERS = {}
+# set by callers that must not block, such as server.py's event loop
+FULFILLMENT_EXECUTOR = None
+# server.py's process keeps running after each response, so chat need not be awaited
+LONG_LIVED = False
+
+
+def on_subscription_snapshot(snapshot, changes, read_time):
+    # evict any broadcaster whose subscription was added, changed or removed
+    with SUBSCRIPTION_LOCK:
+        for change in changes:
+            SUBSCRIPTION_CACHE.pop(change.document.id, None)
+
+
+def watch_subscriptions():
+    global SUBSCRIPTION_WATCH
+    with SUBSCRIPTION_LOCK:
+        if SUBSCRIPTION_WATCH is None:
+            db = database.get_client()
+            subscriptions = db.collection("subscriptions")
+            SUBSCRIPTION_WATCH = subscriptions.on_snapshot(on_subscription_snapshot)
+
+
+def load_subscription(broadcaster_id):
+    db = database.get_client()
+    document = db.collection("subscriptions").document(broadcaster_id).get()
+    metrics.increment("firestore_reads")
+    if document.exists:
+        return document.to_dict()
+    return load_legacy_subscription(broadcaster_id)
+
+
+def load_legacy_subscription(broadcaster_id):
+    # keeps notifications flowing between this deploy and running migrate.py
+    subscription = database.adopt_legacy(
+        "subscriptions",
         broadcaster_id,
-        username,
-        document_id,
+        "broadcaster_id",
+        "==",
+        broadcaster_id,
+        key=lambda x: bool(x.to_dict().get("subscription_id")),
     )
-    return access_token
-
-
-def lookup_token(broadcaster_id):
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    result = tokens.where("broadcaster_id", "==", broadcaster_id)
-    document = result.get()[0]
-    token_data = document.to_dict()
-    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    if token_data.get("expires_at") < now:
-        access_token = regenerate_token(token_data, document.id)
-    else:
-        access_token = token_data.get("access_token")
-    return access_token
-
-
-def lookup_token_and_username():
-    db = firestore.Client()
-    tokens = db.collection("auth-tokens")
-    result = tokens.where("scopes", "array_contains", "chat:edit")
-    document = result.get()[0]
-    token_data = document.to_dict()
-    username = token_data.get("username")
-    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    if token_data.get("expires_at") < now:
-        access_token = regenerate_token(token_data, document.id)
-    else:
-        access_token = token_data.get("access_token")
-    return access_token, username
-
-
-def get_active_subscription(broadcaster_id):
-    db = firestore.Client()
-    subscriptions = db.collection("subscriptions")
-    result = subscriptions.where("broadcaster_id", "==", broadcaster_id)
-    return next((x.to_dict() for x in result.get()), None)
-
-
-def get_random_quote():
-    random_id = random.randint(MIN_RANGE, MAX_RANGE)
-    db = firestore.Client()
-    quotes = db.collection("lotr-quotes")
-    result = quotes.where("id", "==", random_id)
-    documents = result.get()
-    if not documents:
-        return None
-    quote_data = documents[0].to_dict()
-    return quote_data.get("quote") + " -" + quote_data.get("speaker")
+    metrics.increment("firestore_reads")
+    if subscription:
+        LOGGER.warning(f"Re-keyed legacy subscription for {broadcaster_id}")
+        metrics.increment("firestore_writes")
+    return subscription
+
+
+def cached_subscription(broadcaster_id):
+    if SUBSCRIPTION_LISTENER and SUBSCRIPTION_WATCH is None:
+        try:
+            watch_subscriptions()
+        except Exception as e:
+            LOGGER.error(f"Could not watch subscriptions: {e}")
+    now = time.monotonic()
+    with SUBSCRIPTION_LOCK:
+        entry = SUBSCRIPTION_CACHE.get(broadcaster_id)
+        if entry and now - entry[0] < SUBSCRIPTION_CACHE_TTL:
+            SUBSCRIPTION_CACHE.move_to_end(broadcaster_id)
+            return entry[1]
+    return None
+
+
+def cache_subscription(broadcaster_id, subscription, loaded_at):
+    with SUBSCRIPTION_LOCK:
+        SUBSCRIPTION_CACHE[broadcaster_id] = (loaded_at, subscription)
+        SUBSCRIPTION_CACHE.move_to_end(broadcaster_id)
+        while len(SUBSCRIPTION_CACHE) > SUBSCRIPTION_CACHE_SIZE:
+            SUBSCRIPTION_CACHE.popitem(last=False)
+
+
+def get_active_subscription(broadcaster_id, refresh=False):
+    subscription = None if refresh else cached_subscription(broadcaster_id)
+    if subscription:
+        return subscription
+    loaded_at = time.monotonic()
+    subscription = load_subscription(broadcaster_id)
+    if subscription:
+        cache_subscription(broadcaster_id, subscription, loaded_at)
+    return subscription
 
 
 def calculate_message_signature(secret, message_id, timestamp, request_data):
-    hmac_message = message_id + timestamp + request_data
+    # sign the raw body bytes so nothing has to be decoded or concatenated as text
+    hmac_message = message_id.encode("utf-8") + timestamp.encode("utf-8") + request_data
     return (
         "sha256="
         + hmac.new(
-            secret.encode("utf-8"),
-            hmac_message.encode("utf-8"),
-            digestmod=hashlib.sha256,
+            secret.encode("utf-8"), hmac_message, digestmod=hashlib.sha256
         ).hexdigest()
     )
 
 
+def verify_message_signature(secret, message_id, timestamp, request_data, signature):
+    actual_signature = calculate_message_signature(
+        secret, message_id, timestamp, request_data
+    )
+    return hmac.compare_digest(signature.encode("utf-8"), actual_signature.encode())
+
+
 def type_quote_in_chat(username, channel, quote, access_token):
-    ws = WebSocketApp(
-        "wss://irc-ws.chat.twitch.tv:443",
-        on_open=lambda ws: on_open(ws, username, channel, quote, access_token),
-        on_message=on_message,
-        on_error=on_error,
-        on_close=on_close,
+    delivered = chat.send_message(username, channel, quote, access_token)
+    if LONG_LIVED or not delivered or delivered.wait(CHAT_SEND_TIMEOUT):
+        return
+    # a function loses its cpu once it responds, so a message still queued now could
+    # go out minutes later or never; drop it and count it instead
+    if chat.SCHEDULER.withdraw(channel, delivered):
+        depth = chat.SCHEDULER.queue_depth()
+        LOGGER.warning(f"Dropped chat message to #{channel} ({depth} still queued)")
+
+
+def mark_as_fulfilled(redemption_ids, broadcaster_id, reward_id, access_token):
+    # helix accepts up to 50 id parameters per request
+    params = [("id", x) for x in redemption_ids]
+    params += [("broadcaster_id", broadcaster_id), ("reward_id", reward_id)]
+    data = {"status": "FULFILLED"}
+    LOGGER.info(f"{params}\t{data}")
+    result = twitch.helix(
+        "PATCH",
+        "channel_points/custom_rewards/redemptions",
+        access_token,
+        params=params,
+        json=data,
     )
-    ws.run_forever(ping_interval=70, ping_timeout=10)
+    try:
+        result.raise_for_status()
+    except:
+        LOGGER.error(f"Could not mark as fulfilled: {result.text}")
 
 
-def on_message(ws, message):
-    if "PING :tmi.twitch.tv" in message:
-        ws.send("PONG :tmi.twitch.tv")
+def flush_fulfillment(key):
+    with FULFILLMENT_LOCK:
+        redemption_ids = FULFILLMENT_BATCHES.pop(key, None)
+        timer = FULFILLMENT_TIMERS.pop(key, None)
+    if timer:
+        timer.cancel()
+    if not redemption_ids:
+        return
+    broadcaster_id, reward_id = key
+    try:
+        access_token = lookup_token(broadcaster_id)
+        mark_as_fulfilled(redemption_ids, broadcaster_id, reward_id, access_token)
+    except Exception:
+        LOGGER.exception(f"Could not fulfill {len(redemption_ids)} redemptions")
+
+
+def flush_fulfillments():
+    with FULFILLMENT_LOCK:
+        keys = list(FULFILLMENT_BATCHES)
+    for key in keys:
+        flush_fulfillment(key)
+
+
+def queue_fulfillment(redemption_id, broadcaster_id, reward_id):
+    key = (broadcaster_id, reward_id)
+    with FULFILLMENT_LOCK:
+        batch = FULFILLMENT_BATCHES.setdefault(key, [])
+        batch.append(redemption_id)
+        full = len(batch) >= FULFILLMENT_BATCH_SIZE or not FULFILLMENT_BATCH_WINDOW
+        if not full and key not in FULFILLMENT_TIMERS:
+            timer = threading.Timer(
+                FULFILLMENT_BATCH_WINDOW, flush_fulfillment, args=(key,)
+            )
+            timer.daemon = True
+            FULFILLMENT_TIMERS[key] = timer
+            timer.start()
+    if full and FULFILLMENT_EXECUTOR:
+        FULFILLMENT_EXECUTOR.submit(flush_fulfillment, key)
+    elif full:
+        flush_fulfillment(key)
+
+
+def process_redemption(event, subscription=None):
+    redemption_id = event.get("id")
+    broadcaster_id = event.get("broadcaster_user_id")
+    reward_id = event.get("reward", {}).get("id")
+    with metrics.trace("redemption", redemption_id=redemption_id):
+        with metrics.span("quote"):
+            if subscription is None:
+                subscription = get_active_subscription(broadcaster_id) or {}
+            filters = subscription.get("reward_filters", {}).get(reward_id)
+            quote = get_random_quote(filters)
+        if not quote:
+            LOGGER.error("No LotR quotes have been configured")
+            quote = "No LotR quotes have been configured"
+        channel = event.get("broadcaster_user_login")
+        with metrics.span("chat_token"):
+            chat_token, username = lookup_token_and_username()
+        with metrics.span("chat"):
+            type_quote_in_chat(username, channel, quote, chat_token)
+        if FULFILL_REDEMPTIONS:
+            queue_fulfillment(redemption_id, broadcaster_id, reward_id)
 
 
-def on_error(ws, error):
-    LOGGER.error(f"Error in websocket: {error}")
+def run_redemption(event, message_id=None):
+    try:
+        process_redemption(event)
+    except Exception:
+        LOGGER.exception(f"Could not process redemption {event.get('id')}")
+        if message_id:
+            # release the claim so a redelivery is not dropped as a duplicate
+            forget_message(message_id)
 
 
-def on_close(ws, *args):
-    LOGGER.info("Chat closed")
+def enqueue_local(event, message_id):
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS)
+    EXECUTOR.submit(run_redemption, event, message_id)
 
 
-def on_open(ws, username, channel, message, access_token):
-    def run(*args):
-        logger = logging.getLogger(__name__)
-        logger.setLevel(logging.INFO)
-        ws.send(f"PASS oauth:{access_token}")
-        logger.info(f"PASS oauth:{access_token}")
-        ws.send(f"NICK {username}")
-        logger.info(f"NICK {username}")
-        ws.send(f"JOIN #{channel}")
-        logger.info(f"JOIN #{channel}")
-        ws.send(f"PRIVMSG #{channel} :{message}")
-        logger.info(f"PRIVMSG #{channel} :{message}")
-        ws.keep_running = False
+def enqueue_pubsub(event, message_id):
+    # pubsub redelivers failed redemptions itself, so the claim is kept
+    global PUBLISHER
+    if PUBLISHER is None:
+        # only deployments using this backend pay for the import
+        from google.cloud import pubsub_v1
 
-    threading.Thread(None, run).start()
+        PUBLISHER = pubsub_v1.PublisherClient()
+    PUBLISHER.publish(QUEUE_TOPIC, json.dumps(event).encode("utf-8"))
 
 
-def mark_as_fulfilled(redemption_id, broadcaster_id, reward_id, access_token):
-    url = (
-        "https://api.twitch.tv/helix/channel_points/custom_rewards/redemptions"
-        + "?id="
-        + quote_plus(redemption_id)
-        + "&broadcaster_id="
-        + quote_plus(broadcaster_id)
-        + "&reward_id="
-        + quote_plus(reward_id)
-    )
-    data = {"status": "FULFILLED"}
-    LOGGER.info(f"{url}\t{data}")
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Client-Id": CLIENT_ID,
-    }
-    result = requests.patch(url, headers=headers, json=data)
+QUEUE_BACKENDS = {
+    "local": enqueue_local,
+    "pubsub": enqueue_pubsub,
+}
+
+
+def enqueue_redemption(event, message_id):
+    QUEUE_BACKENDS[QUEUE_BACKEND](event, message_id)
+
+
+def worker(event, context):
+    # entry point for a Pub/Sub-triggered function consuming the pubsub backend
+    process_redemption(json.loads(base64.b64decode(event.get("data"))))
+
+
+def parse_timestamp(timestamp):
+    # eventsub timestamps carry nanoseconds, which datetime cannot parse
+    parsed = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def is_duplicate(message_id):
+    cutoff = time.time() - DEDUP_WINDOW
+    with SEEN_LOCK:
+        # entries arrive roughly in timestamp order, so expired ones sit at the front
+        while SEEN_MESSAGES and next(iter(SEEN_MESSAGES.values())) < cutoff:
+            SEEN_MESSAGES.popitem(last=False)
+        return message_id in SEEN_MESSAGES
+
+
+def claim_message(message_id, message_time):
+    # check and insert under one lock so concurrent retries cannot both win
+    with SEEN_LOCK:
+        if message_id in SEEN_MESSAGES:
+            return False
+        SEEN_MESSAGES[message_id] = message_time
+        while len(SEEN_MESSAGES) > DEDUP_MAX_ENTRIES:
+            SEEN_MESSAGES.popitem(last=False)
+    return True
+
+
+def release_message(message_id):
+    with SEEN_LOCK:
+        SEEN_MESSAGES.pop(message_id, None)
+
+
+def message_record(message_time):
+    expires_at = datetime.fromtimestamp(message_time + DEDUP_WINDOW, timezone.utc)
+    return {"expires_at": expires_at}
+
+
+def remember_message(message_id, message_time):
+    if not claim_message(message_id, message_time):
+        return False
+    if DEDUP_BACKEND != "firestore":
+        return True
+    db = database.get_client()
+    messages = db.collection("eventsub-messages")
     try:
-        result.raise_for_status()
-    except:
-        LOGGER.error(f"Could not mark as fulfilled: {result.text}")
+        # create() fails if another instance already handled this message
+        messages.document(message_id).create(message_record(message_time))
+        metrics.increment("firestore_writes")
+    except AlreadyExists:
+        return False
+    except Exception:
+        # the claim did not land, so twitch's retry must not look like a duplicate
+        release_message(message_id)
+        raise
+    return True
+
+
+def forget_message(message_id):
+    release_message(message_id)
+    if DEDUP_BACKEND == "firestore":
+        db = database.get_client()
+        db.collection("eventsub-messages").document(message_id).delete()
+        metrics.increment("firestore_writes")
 
 
 def handler(request):
-    # look up the secret from the broadcaster id (along with other subscription data)
-    LOGGER.info(request.data.decode("utf-8"))
+    if metrics.METRICS_ENDPOINT and request.path == "/metrics":
+        return metrics.handler(request)
+    message_id = request.headers.get("Twitch-Eventsub-Message-Id")
+    message_type = request.headers.get("Twitch-Eventsub-Message-Type")
+    with metrics.trace("webhook", message_id=message_id, message_type=message_type):
+        return handle_message(request, message_id, message_type)
+
+
+def check_headers(message_id, message_type, timestamp):
+    # returns the message time, or a response when the message can be answered early
+    try:
+        message_time = parse_timestamp(timestamp)
+    except (TypeError, ValueError):
+        LOGGER.error(f"Invalid message timestamp: {timestamp}")
+        return None, ("Bad request", 400)
+    if not message_id:
+        LOGGER.error("Missing message id")
+        return None, ("Bad request", 400)
+    # twitch never sends anything older than this, so treat it as a replay
+    if time.time() - message_time > DEDUP_WINDOW:
+        LOGGER.warning(f"Rejecting stale message {message_id} from {timestamp}")
+        return None, ("Forbidden", 403)
+    if message_type == "notification" and is_duplicate(message_id):
+        LOGGER.info(f"Ignoring duplicate delivery of {message_id}")
+        return None, ("", 204)
+    return message_time, None
+
+
+def parse_payload(request_data):
+    # parse the body once and pull out everything the handler needs
+    LOGGER.debug(request_data)
+    payload = json.loads(request_data)
+    event = payload.get("event", {})
     broadcaster_id = (
-        request.json.get("subscription", {})
-        .get("condition", {})
-        .get("broadcaster_user_id")
+        payload.get("subscription", {}).get("condition", {}).get("broadcaster_user_id")
     )
-    active_subscription = get_active_subscription(broadcaster_id)
-    if not active_subscription:
-        LOGGER.error("Unable to find active subscription")
-        return "Invalid subscription", 404
-    else:
-        connected_rewards = active_subscription.get("reward_ids", [])
+    return payload, event, broadcaster_id
 
-    # validate the message signature
-    secret = active_subscription.get("secret")
-    message_id = request.headers.get("Twitch-Eventsub-Message-Id")
-    timestamp = request.headers.get("Twitch-Eventsub-Message-Timestamp")
-    response_data = request.data.decode("utf-8")
 
-    actual_signature = calculate_message_signature(
-        secret, message_id, timestamp, response_data
-    )
-    expected_signature = request.headers.get("Twitch-Eventsub-Message-Signature")
-    if expected_signature != actual_signature:
-        LOGGER.error(f"Signature mismatch: {actual_signature} vs {expected_signature}")
-        LOGGER.warning(f"Broadcaster: {broadcaster_id}; Headers: {request.headers}")
-        return "Forbidden", 403
+def subscription_verified(subscription, message_id, timestamp, data, signature):
+    if not subscription:
+        return False
+    secret = subscription.get("secret")
+    return verify_message_signature(secret, message_id, timestamp, data, signature)
 
-    # delegate two different message types
-    message_type = request.headers.get("Twitch-Eventsub-Message-Type")
+
+def signature_mismatch(message_id, signature, broadcaster_id, headers):
+    LOGGER.error(f"Signature mismatch for message {message_id}: {signature}")
+    LOGGER.warning(f"Broadcaster: {broadcaster_id}; Headers: {headers}")
+    return "Forbidden", 403
+
+
+def route_message(message_type, payload):
+    # answers everything but notifications, which still need dedup and redemption
     if message_type == "webhook_callback_verification":
-        challenge = request.json.get("challenge")
+        challenge = payload.get("challenge")
         LOGGER.info(f"Challenge responded with {challenge}")
         return challenge, 200, {"Content-Type": "text/plain"}
-    elif message_type == "notification":
-        redemption_id = request.json.get("event", {}).get("id")
-        reward_id = request.json.get("event", {}).get("reward", {}).get("id")
-        if reward_id in connected_rewards:
-            quote = get_random_quote()
-            if not quote:
-                LOGGER.error("No LotR quotes have been configured")
-                quote = "No LotR quotes have been configured"
-            channel = request.json.get("event", {}).get("broadcaster_user_login")
-            chat_token, username = lookup_token_and_username()
-            type_quote_in_chat(username, channel, quote, chat_token)
-            # access_token = lookup_token(broadcaster_id)
-            # mark_as_fulfilled(redemption_id, broadcaster_id, reward_id, access_token)
-        else:
-            LOGGER.info("Reward not connected to subscription")
-        return "", 204
-    else:
+    if message_type != "notification":
         LOGGER.error(f"Message Type: {message_type}")
         return "Unknown message type", 501
+    return None
+
+
+def reward_connected(event, subscription):
+    reward_id = event.get("reward", {}).get("id")
+    if reward_id in (subscription or {}).get("reward_ids", []):
+        return True
+    LOGGER.info("Reward not connected to subscription")
+    return False
+
+
+def handle_message(request, message_id, message_type):
+    timestamp = request.headers.get("Twitch-Eventsub-Message-Timestamp")
+    message_time, response = check_headers(message_id, message_type, timestamp)
+    if response:
+        return response
+    request_data = request.get_data()
+    payload, event, broadcaster_id = parse_payload(request_data)
+
+    # look up the secret from the broadcaster id (along with other subscription data)
+    with metrics.span("subscription"):
+        subscription = get_active_subscription(broadcaster_id)
+    if not subscription:
+        LOGGER.error("Unable to find active subscription")
+        return "Invalid subscription", 404
+
+    # validate the message signature
+    signature = request.headers.get("Twitch-Eventsub-Message-Signature", "")
+    args = (message_id, timestamp, request_data, signature)
+    with metrics.span("signature"):
+        verified = subscription_verified(subscription, *args)
+    if not verified:
+        # the cached secret may be stale, so re-read the subscription once
+        subscription = get_active_subscription(broadcaster_id, refresh=True)
+        if not subscription_verified(subscription, *args):
+            headers = request.headers
+            return signature_mismatch(message_id, signature, broadcaster_id, headers)
+
+    response = route_message(message_type, payload)
+    if response:
+        return response
+    if not remember_message(message_id, message_time):
+        LOGGER.info(f"Ignoring duplicate delivery of {message_id}")
+        return "", 204
+    if reward_connected(event, subscription):
+        if WEBHOOK_ASYNC:
+            enqueue_redemption(event, message_id)
+        else:
+            try:
+                process_redemption(event, subscription)
+            except Exception:
+                # let twitch's retry through since this delivery did not land
+                forget_message(message_id)
+                raise
+    return "", 204